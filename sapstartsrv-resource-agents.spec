@@ -42,6 +42,7 @@ BuildRequires:  python3-psutil
 
 %define raname SAPStartSrv
 %define srvname sapservices-move
+%define idxname sapstartsrv-index
 %define ocf_dir %{_prefix}/lib/ocf
 
 %description
@@ -68,6 +69,7 @@ install -d %{buildroot}%{_mandir}/man8
 install -m 0444 man/*.7.gz %{buildroot}%{_mandir}/man7
 install -m 0444 man/*.8.gz %{buildroot}%{_mandir}/man8
 install -D -m 0644 sbin/%{srvname}.in %{buildroot}%{_sbindir}/%{srvname}
+install -D -m 0644 sbin/%{idxname}.in %{buildroot}%{_sbindir}/%{idxname}
 install -d %{buildroot}%{_unitdir}
 install -m 0644 service/* %{buildroot}%{_unitdir}
 ln -s /usr/sbin/service %{buildroot}%{_sbindir}/rcsapping
@@ -75,6 +77,7 @@ ln -s /usr/sbin/service %{buildroot}%{_sbindir}/rcsappong
 
 sed -i 's+@PYTHON@+%{_bindir}/python3+' %{buildroot}%{ocf_dir}/resource.d/suse/%{raname}
 sed -i 's+@PYTHON@+%{_bindir}/python3+' %{buildroot}%{_sbindir}/%{srvname}
+sed -i 's+@PYTHON@+%{_bindir}/python3+' %{buildroot}%{_sbindir}/%{idxname}
 
 %if %{with test}
 %check
@@ -82,16 +85,16 @@ pytest tests
 %endif
 
 %pre
-%service_add_pre sapping.service sappong.service
+%service_add_pre sapping.service sappong.service %{idxname}.service
 
 %post
-%service_add_post sapping.service sappong.service
+%service_add_post sapping.service sappong.service %{idxname}.service
 
 %preun
-%service_del_preun sapping.service sappong.service
+%service_del_preun sapping.service sappong.service %{idxname}.service
 
 %postun
-%service_del_postun sapping.service sappong.service
+%service_del_postun sapping.service sappong.service %{idxname}.service
 
 %files
 %defattr(-,root,root)
@@ -11,10 +11,22 @@ Unitary tests for SAPStartSrv resource agent.
 # pylint:disable=C0103,C0111,W0212,W0611
 
 import os
+import json
 import sys
 import unittest
 import subprocess
 import logging
+import re
+import socketserver
+import threading
+import xml.etree.ElementTree as ElementTree
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import psutil
 
 try:
     import imp
@@ -46,6 +58,96 @@ SAPStartSrv = load_source(
     os.path.abspath(os.path.join(os.path.dirname(__file__), '../ra/SAPStartSrv.in')))
 
 
+SOAP_RESPONSE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:SAPControl="urn:SAPControl"><SOAP-ENV:Body>{}</SOAP-ENV:Body></SOAP-ENV:Envelope>')
+
+CANNED_RESPONSES = {
+    'StopService': (200, '<SAPControl:StopServiceResponse></SAPControl:StopServiceResponse>'),
+    'GetProcessList': (
+        200,
+        '<SAPControl:GetProcessListResponse><process>'
+        '<item><name>msg_server</name><description>MessageServer</description>'
+        '<dispstatus>SAPControl-GREEN</dispstatus><textstatus>Running</textstatus>'
+        '<starttime>2026 10 18 10:00:00</starttime><elapsedtime>1:00:00</elapsedtime>'
+        '<pid>1234</pid></item>'
+        '<item><name>enq_server</name><description>Enqueue Server 2</description>'
+        '<dispstatus>SAPControl-GRAY</dispstatus><textstatus>Stopped</textstatus>'
+        '<starttime></starttime><elapsedtime></elapsedtime><pid>-1</pid></item>'
+        '</process></SAPControl:GetProcessListResponse>'),
+    'ParameterValue': (
+        200,
+        '<SAPControl:ParameterValueResponse><value>PRD</value>'
+        '</SAPControl:ParameterValueResponse>'),
+}
+
+SOAP_FAULT = (
+    500,
+    '<SOAP-ENV:Fault><faultcode>SOAP-ENV:Server</faultcode>'
+    '<faultstring>Permission denied</faultstring></SOAP-ENV:Fault>')
+
+
+class CannedSapControlHandler(socketserver.StreamRequestHandler):
+    """
+    Stand-in for the sapstartsrv web service answering with canned SOAP responses
+    """
+
+    def handle(self):
+        headers = {}
+        self.rfile.readline()
+        for line in iter(self.rfile.readline, b'\r\n'):
+            name, value = line.decode().split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        request = self.rfile.read(int(headers['content-length'])).decode()
+        self.server.requests.append(request)
+
+        function = re.search(r'<SAPControl:(\w+)', request).group(1)
+        status, body = self.server.responses.get(function, SOAP_FAULT)
+        data = SOAP_RESPONSE.format(body).encode()
+        self.wfile.write(
+            'HTTP/1.1 {} OK\r\nContent-Type: text/xml; charset=utf-8\r\n'
+            'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                status, len(data)).encode())
+        self.wfile.write(data)
+
+
+class CannedSapControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server running CannedSapControlHandler in a background thread
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, responses=None):
+        socketserver.UnixStreamServer.__init__(self, socket_path, CannedSapControlHandler)
+        self.responses = CANNED_RESPONSES if responses is None else responses
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def command_result(returncode=0, output='', err='', timed_out=False):
+    '''
+    Get the result of a command run by SAPStartSrv.run_command
+    '''
+    return SAPStartSrv.ProcessResult('cmd', returncode, output.encode(), err.encode(), timed_out)
+
+
+# Modules the agent only imports in the actions needing them
+DEFERRED_MODULES = (
+    'psutil', 'subprocess', 'shlex', 'json', 'socket', 'select', 'fcntl', 'ctypes',
+    'http.client', 'xml.etree.ElementTree', 'asyncio', 'concurrent.futures')
+
+
 class TestSAPStartSrv(unittest.TestCase):
     """
     Unitary tests for SAPStartSrv.in
@@ -71,11 +173,27 @@ class TestSAPStartSrv(unittest.TestCase):
         self._agent = SAPStartSrv.SapStartSrv(
             '{}_{}{}_{}'.format(
                 self._sid, self._instance_name, self._instance_number, self._virtualhost))
+        self._state_dir = tempfile.mkdtemp()
+        self._state_dir_patcher = mock.patch('SAPStartSrv.STATE_DIR', self._state_dir)
+        self._state_dir_patcher.start()
+        self._timer_patcher = mock.patch('SAPStartSrv.TIMER', SAPStartSrv.ActionTimer())
+        self._timer_patcher.start()
+        self._helper_socket = os.path.join(self._state_dir, 'index.sock')
+        self._helper_socket_patcher = mock.patch(
+            'SAPStartSrv.INDEX_HELPER_SOCKET', self._helper_socket)
+        self._helper_socket_patcher.start()
+        self._action_start_patcher = mock.patch('SAPStartSrv.ACTION_START', time.monotonic())
+        self._action_start_patcher.start()
 
     def tearDown(self):
         """
         Test tearDown.
         """
+        self._action_start_patcher.stop()
+        self._helper_socket_patcher.stop()
+        self._timer_patcher.stop()
+        self._state_dir_patcher.stop()
+        shutil.rmtree(self._state_dir)
 
     @classmethod
     def tearDownClass(cls):
@@ -83,16 +201,123 @@ class TestSAPStartSrv(unittest.TestCase):
         Global tearDown.
         """
 
+    def test_xml_escape(self):
+        assert SAPStartSrv.xml_escape('a<b>&c') == 'a&lt;b&gt;&amp;c'
+
+    @mock.patch('sys.stdout')
+    def test_run_fast_action_meta_data(self, mock_stdout):
+        assert SAPStartSrv.run_fast_action('meta-data') == 0
+        mock_stdout.write.assert_called_once_with(SAPStartSrv.META_DATA)
+
+    def test_run_fast_action_monitor(self):
+        with mock.patch.dict(os.environ, {'OCF_RESKEY_CRM_meta_interval': '120000'}):
+            os.environ.pop('OCF_CHECK_LEVEL', None)
+            assert SAPStartSrv.run_fast_action('monitor') == 0
+
+            os.environ['OCF_CHECK_LEVEL'] = '10'
+            assert SAPStartSrv.run_fast_action('monitor') is None
+
+        with mock.patch.dict(os.environ, {
+                'OCF_RESKEY_CRM_meta_interval': '60000', 'OCF_RESKEY_OCF_CHECK_LEVEL': '10'}):
+            os.environ.pop('OCF_CHECK_LEVEL', None)
+            assert SAPStartSrv.run_fast_action('monitor') is None
+
+        with mock.patch.dict(os.environ, {'OCF_RESKEY_CRM_meta_interval': '0'}):
+            os.environ.pop('OCF_CHECK_LEVEL', None)
+            assert SAPStartSrv.run_fast_action('monitor') is None
+
+        assert SAPStartSrv.run_fast_action('start') is None
+        assert SAPStartSrv.run_fast_action(None) is None
+
+    @mock.patch('ocf.Agent')
+    @mock.patch('ocf.get_parameter')
+    def test_meta_data(self, mock_get_parameter, mock_ocf_agent):
+        agent = mock.Mock()
+        mock_ocf_agent.return_value = agent
+        mock_get_parameter.return_value = 'PRD_ASCS00_virthost'
+
+        SAPStartSrv.main()
+
+        # The meta-data answered without the ocf module matches what main() passes to it
+        root = ElementTree.fromstring(SAPStartSrv.META_DATA)
+        assert root.get('name') == 'SAPStartSrv'
+        assert root.findtext('longdesc').strip() == SAPStartSrv.LONG_DESC
+        assert root.findtext('shortdesc') == SAPStartSrv.SHORT_DESC
+        parameters = [{
+            'name': param.get('name'),
+            'shortdesc': param.findtext('shortdesc'),
+            'longdesc': param.findtext('longdesc').strip(),
+            'content_type': param.find('content').get('type'),
+            'default': param.find('content').get('default'),
+            'unique': param.get('unique') == '1',
+            'required': param.get('required') == '1'
+        } for param in root.iter('parameter')]
+        assert parameters == [dict({
+            'unique': False, 'required': False}, **call[1])
+            for call in agent.add_parameter.call_args_list]
+
+        actions = [{
+            'name': action.get('name'),
+            'timeout': action.get('timeout'),
+            'interval': action.get('interval'),
+            'depth': action.get('depth')
+        } for action in root.iter('action')]
+        assert actions == [{
+            'name': call[1]['name'],
+            'timeout': '{}s'.format(call[1]['timeout']),
+            'interval': '{}s'.format(call[1]['interval']) if 'interval' in call[1] else None,
+            'depth': str(call[1]['depth']) if 'depth' in call[1] else None
+        } for call in agent.add_action.call_args_list] + [{
+            'name': 'meta-data', 'timeout': '5s', 'interval': None, 'depth': None}]
+
+    def test_render_meta_data_escape(self):
+        parameters = ({
+            'name': 'P', 'shortdesc': 'a < b', 'longdesc': 'a & b', 'content_type': 'string',
+            'default': '<x>'},)
+        with mock.patch('SAPStartSrv.PARAMETERS', parameters):
+            root = ElementTree.fromstring(SAPStartSrv.render_meta_data())
+
+        param = root.find('parameters/parameter')
+        assert param.findtext('shortdesc') == 'a < b'
+        assert param.findtext('longdesc').strip() == 'a & b'
+        assert param.find('content').get('default') == '<x>'
+
+    def test_import_deferred_modules(self):
+        script = (
+            'import sys, types, importlib.machinery, importlib.util\n'
+            'sys.modules["ocf"] = types.ModuleType("ocf")\n'
+            'sys.modules["ocf"].logger = None\n'
+            'path = sys.argv[1]\n'
+            'loader = importlib.machinery.SourceFileLoader("SAPStartSrv", path)\n'
+            'spec = importlib.util.spec_from_file_location("SAPStartSrv", path, loader=loader)\n'
+            'loader.exec_module(importlib.util.module_from_spec(spec))\n'
+            'print(" ".join(sorted(sys.modules)))\n')
+        modules = subprocess.check_output([
+            sys.executable, '-c', script,
+            os.path.join(os.path.dirname(__file__), '../ra/SAPStartSrv.in')]).decode().split()
+
+        for module in DEFERRED_MODULES:
+            assert module not in modules, '{} imported at agent startup'.format(module)
+
     def test_process_result(self):
         result = SAPStartSrv.ProcessResult('cmd', 0, b'output', b'error')
         assert result.cmd == 'cmd'
         assert result.returncode == 0
         assert result.output == 'output'
         assert result.err == 'error'
+        assert result.get_error() == 'error'
+
+        result = SAPStartSrv.ProcessResult('cmd', 124, b'', b'error', timed_out=True)
+        assert result.get_error() == 'timed out, killed at the action deadline'
 
     @mock.patch('SAPStartSrv.ProcessResult')
     @mock.patch('subprocess.Popen')
-    def test_run_command(self, mock_popen, mock_process_result):
+    @mock.patch('SAPStartSrv.time.monotonic')
+    @mock.patch('SAPStartSrv.get_action_deadline')
+    def test_run_command(
+            self, mock_get_action_deadline, mock_monotonic, mock_popen, mock_process_result):
+        mock_get_action_deadline.return_value = 54
+        mock_monotonic.return_value = 4
         mock_process = mock.Mock(returncode=0)
         mock_process.communicate.return_value = ['output', 'error']
         mock_popen.return_value = mock_process
@@ -103,15 +328,1083 @@ class TestSAPStartSrv(unittest.TestCase):
         assert result == 'result'
 
         mock_popen.assert_called_once_with(
-            ['cmd'], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-        mock_process.communicate.assert_called_once_with()
+            ['cmd'], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True, env=None)
+        mock_process.communicate.assert_called_once_with(timeout=50)
         mock_process_result.assert_called_once_with('cmd', 0, 'output', 'error')
 
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('os.killpg')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('SAPStartSrv.time.monotonic')
+    def test_run_command_timeout(self, mock_monotonic, mock_popen, mock_killpg, mock_logger):
+        mock_monotonic.return_value = 10
+        mock_process = mock.Mock(pid=1234, returncode=-9)
+        mock_process.communicate.side_effect = [
+            subprocess.TimeoutExpired('systemctl', 5), (b'partial', b'')]
+        mock_popen.return_value = mock_process
+
+        result = SAPStartSrv.run_command('/usr/bin/systemctl start SAPPRD_00.service', 15)
+        assert result.timed_out
+        assert result.returncode == SAPStartSrv.COMMAND_TIMEOUT_RC
+        assert result.output == 'partial'
+
+        mock_process.communicate.assert_has_calls([mock.call(timeout=5), mock.call()])
+        mock_killpg.assert_called_once_with(1234, signal.SIGKILL)
+        mock_logger.assert_called_once_with(
+            '/usr/bin/systemctl start SAPPRD_00.service did not finish in 5.0 seconds, '
+            'killing it')
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('SAPStartSrv.time.monotonic')
+    def test_run_command_deadline_expired(self, mock_monotonic, mock_popen, mock_logger):
+        mock_monotonic.return_value = 20
+
+        result = SAPStartSrv.run_command('/usr/bin/systemctl is-active SAPPRD_00.service', 15)
+        assert result.timed_out
+        assert result.returncode == SAPStartSrv.COMMAND_TIMEOUT_RC
+
+        mock_popen.assert_not_called()
+        mock_logger.assert_called_once_with(
+            'Not running /usr/bin/systemctl is-active SAPPRD_00.service: '
+            'the action deadline expired')
+
+    def test_run_command_kill_process_group(self):
+        start = time.monotonic()
+        result = SAPStartSrv.run_command(
+            'sh -c "sleep 30 & sleep 30"', time.monotonic() + 0.2)
+        assert result.timed_out
+        assert time.monotonic() - start < 5
+
+    @mock.patch('SAPStartSrv.time.monotonic')
+    def test_action_timer_phase(self, mock_monotonic):
+        timer = SAPStartSrv.ActionTimer()
+        with timer.phase('process_lookup'):
+            pass
+        assert timer.phases == {}
+        mock_monotonic.assert_not_called()
+
+        timer.enabled = True
+        mock_monotonic.side_effect = [1, 1.5, 2, 2.25]
+        with timer.phase('process_lookup'):
+            pass
+        with timer.phase('process_lookup'):
+            pass
+        assert timer.phases == {'process_lookup': 0.75}
+
+    @mock.patch('SAPStartSrv.logger')
+    @mock.patch('SAPStartSrv.time.time')
+    def test_action_timer_report(self, mock_time, mock_logger):
+        mock_time.return_value = 100
+        timer = SAPStartSrv.ActionTimer()
+        timer.add('initialize', 0.25)
+        timer.report('PRD_ASCS00_virthost', 'start', 0, 1.5)
+        timer.add('initialize', 0.5)
+        timer.report('PRD_ASCS00_virthost', 'stop', 1, 2)
+
+        with open(os.path.join(self._state_dir, 'timing.log')) as timing_log:
+            records = [json.loads(line) for line in timing_log]
+        assert records == [
+            {'time': 100, 'resource': 'PRD_ASCS00_virthost', 'action': 'start', 'rc': 0,
+             'total': 1.5, 'phases': {'initialize': 0.25}},
+            {'time': 100, 'resource': 'PRD_ASCS00_virthost', 'action': 'stop', 'rc': 1,
+             'total': 2, 'phases': {'initialize': 0.5}}]
+        assert timer.phases == {}
+        assert mock_logger.info.call_count == 2
+
+    @mock.patch('SAPStartSrv.TIMING_LOG_MAX_SIZE', 400)
+    @mock.patch('SAPStartSrv.logger')
+    def test_action_timer_report_rotate(self, mock_logger):
+        timing_log_path = os.path.join(self._state_dir, 'timing.log')
+        with open(timing_log_path, 'w') as timing_log:
+            timing_log.write('x' * 401)
+
+        timer = SAPStartSrv.ActionTimer()
+        timer.report('PRD_ASCS00_virthost', 'start', 0, 1)
+        with open(timing_log_path + '.1') as timing_log:
+            assert timing_log.read() == 'x' * 401
+        with open(timing_log_path) as timing_log:
+            assert len(timing_log.readlines()) == 1
+
+        # Below the limit the record is appended
+        timer.report('PRD_ASCS00_virthost', 'stop', 0, 1)
+        with open(timing_log_path) as timing_log:
+            assert len(timing_log.readlines()) == 2
+        assert mock_logger.warning.call_count == 0
+
+    def test_action_timer_threads(self):
+        timer = SAPStartSrv.ActionTimer()
+        timer.add('initialize', 1)
+
+        def run():
+            timer.add('process_lookup', 2)
+            thread_phases.append(dict(timer.phases))
+            timer.phases = {}
+
+        thread_phases = []
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        assert thread_phases == [{'process_lookup': 2}]
+        assert timer.phases == {'initialize': 1}
+
+    @mock.patch('SAPStartSrv.logger')
+    def test_action_timer_report_error(self, mock_logger):
+        with mock.patch('SAPStartSrv.STATE_DIR', os.path.join(self._state_dir, 'file')):
+            open(SAPStartSrv.STATE_DIR, 'w').close()
+            SAPStartSrv.ActionTimer().report('PRD_ASCS00_virthost', 'start', 0, 1)
+        mock_logger.warning.assert_called_once_with(mock.ANY)
+
+    @mock.patch('SAPStartSrv.TIMER')
+    def test_timed_phase(self, mock_timer):
+        @SAPStartSrv.timed_phase('initialize')
+        def function(value):
+            return value
+
+        assert function(5) == 5
+        mock_timer.phase.assert_called_once_with('initialize')
+        mock_timer.phase.return_value.__enter__.assert_called_once_with()
+
+    @mock.patch('SAPStartSrv.time.monotonic')
+    @mock.patch('SAPStartSrv.TIMER')
+    def test_timed_action(self, mock_timer, mock_monotonic):
+        @SAPStartSrv.timed_action('start')
+        def action(agent):
+            return 7
+
+        mock_timer.enabled = False
+        assert action(self._agent) == 7
+        mock_timer.report.assert_not_called()
+
+        mock_timer.enabled = True
+        mock_monotonic.side_effect = [10, 12.5]
+        assert action(self._agent) == 7
+        mock_timer.report.assert_called_once_with('PRD_ASCS00_virthost', 'start', 7, 2.5)
+
+    @mock.patch('SAPStartSrv.ProcessResult')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('SAPStartSrv.TIMER')
+    def test_run_command_timing(self, mock_timer, mock_popen, mock_process_result):
+        mock_popen.return_value.communicate.return_value = ['output', 'error']
+        SAPStartSrv.run_command('/usr/bin/systemctl start SAPPRD_00.service')
+        mock_timer.phase.assert_called_once_with('command:systemctl')
+
+    def test_get_profile_pattern(self):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        self._agent.virtual_host = 'virthost'
+        assert self._agent._get_profile_pattern() == r'pf=.*/PRD_ASCS00_virthost'
+
+    def test_get_action_timeout(self):
+        with mock.patch.dict(os.environ, {'OCF_RESKEY_CRM_meta_timeout': '20000'}):
+            assert SAPStartSrv.get_action_timeout() == 20
+
+        with mock.patch.dict(os.environ, {'OCF_RESKEY_CRM_meta_timeout': ''}):
+            assert SAPStartSrv.get_action_timeout() == SAPStartSrv.DEFAULT_ACTION_TIMEOUT
+
+    @mock.patch('time.monotonic')
+    @mock.patch('SAPStartSrv.get_action_timeout')
+    def test_get_action_deadline(self, mock_get_action_timeout, mock_monotonic):
+        mock_get_action_timeout.return_value = 60
+        mock_monotonic.return_value = 1030
+
+        with mock.patch('SAPStartSrv.ACTION_START', 1000):
+            assert SAPStartSrv.get_action_deadline() == 1054
+
+    def test_wait_for_process_exit(self):
+        child = subprocess.Popen(['sleep', '30'])
+        try:
+            proc = psutil.Process(child.pid)
+            assert SAPStartSrv.wait_for_process_exit(proc, 0.05) is False
+            child.kill()
+            assert SAPStartSrv.wait_for_process_exit(proc, 5) is True
+        finally:
+            child.kill()
+            child.wait()
+
+    @mock.patch('os.pidfd_open', create=True)
+    def test_wait_for_process_exit_no_pidfd(self, mock_pidfd_open):
+        mock_pidfd_open.side_effect = OSError(38, 'Function not implemented')
+        proc = mock.Mock(pid=1234)
+        proc.wait.side_effect = [None, psutil.TimeoutExpired(1), psutil.NoSuchProcess(1234)]
+
+        assert SAPStartSrv.wait_for_process_exit(proc, 1) is True
+        assert SAPStartSrv.wait_for_process_exit(proc, -1) is False
+        assert SAPStartSrv.wait_for_process_exit(proc, 1) is True
+        proc.wait.assert_has_calls([mock.call(1), mock.call(0), mock.call(1)])
+
+        mock_pidfd_open.side_effect = OSError(3, 'No such process')
+        assert SAPStartSrv.wait_for_process_exit(proc, 1) is True
+        assert proc.wait.call_count == 3
+
+    @mock.patch('SAPStartSrv.time.monotonic')
+    @mock.patch('SAPStartSrv.wait_for_process_exit')
+    def test_wait_for_exit(self, mock_wait_for_process_exit, mock_monotonic):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        proc = mock.Mock(pid=1234)
+        mock_monotonic.return_value = 10
+
+        assert self._agent._wait_for_exit(None, 60) is True
+
+        mock_wait_for_process_exit.return_value = True
+        assert self._agent._wait_for_exit(proc, 60) is True
+        mock_wait_for_process_exit.assert_called_once_with(proc, 40)
+        assert proc.send_signal.call_count == 0
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.time.monotonic')
+    @mock.patch('SAPStartSrv.wait_for_process_exit')
+    def test_wait_for_exit_escalation(
+            self, mock_wait_for_process_exit, mock_monotonic, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        proc = mock.Mock(pid=1234)
+        mock_monotonic.side_effect = [10, 10, 50, 55]
+
+        mock_wait_for_process_exit.side_effect = [False, False, True]
+        assert self._agent._wait_for_exit(proc, 60) is True
+        mock_wait_for_process_exit.assert_has_calls([
+            mock.call(proc, 40), mock.call(proc, 5), mock.call(proc, 5)])
+        proc.send_signal.assert_has_calls([
+            mock.call(signal.SIGTERM), mock.call(signal.SIGKILL)])
+        mock_logger.assert_has_calls([
+            mock.call('sapstartsrv of SAP Instance PRD_ASCS00 (PID 1234) is still running, '
+                      'sending SIGTERM'),
+            mock.call('sapstartsrv of SAP Instance PRD_ASCS00 (PID 1234) is still running, '
+                      'sending SIGKILL')])
+
+        mock_monotonic.side_effect = [10, 10, 50, 55]
+        mock_wait_for_process_exit.side_effect = [False, False, False]
+        assert self._agent._wait_for_exit(proc, 60) is False
+
+        mock_monotonic.side_effect = [10, 10]
+        mock_wait_for_process_exit.side_effect = [False]
+        proc.send_signal.side_effect = psutil.NoSuchProcess(1234)
+        assert self._agent._wait_for_exit(proc, 60) is True
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.time.monotonic')
+    @mock.patch('SAPStartSrv.wait_for_process_exit')
+    def test_wait_for_exit_short_timeout(
+            self, mock_wait_for_process_exit, mock_monotonic, mock_logger):
+        proc = mock.Mock(pid=1234)
+        # 8 seconds left: StopService keeps 4 seconds, SIGTERM and SIGKILL get 2 each
+        mock_monotonic.side_effect = [10, 10, 14, 16]
+        mock_wait_for_process_exit.side_effect = [False, False, True]
+
+        assert self._agent._wait_for_exit(proc, 18) is True
+
+        mock_wait_for_process_exit.assert_has_calls([
+            mock.call(proc, 4), mock.call(proc, 2), mock.call(proc, 2)])
+        proc.send_signal.assert_has_calls([
+            mock.call(signal.SIGTERM), mock.call(signal.SIGKILL)])
+
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.wait_for_process_exit')
+    def test_wait_for_exit_access_denied(
+            self, mock_wait_for_process_exit, mock_warning, mock_error):
+        proc = mock.Mock(pid=1234)
+        proc.send_signal.side_effect = psutil.AccessDenied(1234)
+        mock_wait_for_process_exit.return_value = False
+        assert self._agent._wait_for_exit(proc, 0) is False
+        mock_error.assert_called_once_with(mock.ANY)
+
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    def test_confirm_stop(self, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        proc = mock.Mock(pid=1234)
+        SAPStartSrv.write_state('PRD_ASCS00_virthost.pid', {'pid': 1234})
+        self._agent._wait_for_exit = mock.Mock(return_value=True)
+
+        assert self._agent._confirm_stop(proc, 60) == 0
+        self._agent._wait_for_exit.assert_called_once_with(proc, 60)
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
+
+        self._agent._wait_for_exit.return_value = False
+        assert self._agent._confirm_stop(proc, 60) == 1
+        mock_logger.assert_called_once_with(
+            'sapstartsrv of SAP Instance PRD_ASCS00 (PID 1234) did not exit')
+
+    def test_background_call(self):
+        SAPStartSrv.TIMER.phases = {'initialize': 1}
+
+        def call():
+            SAPStartSrv.TIMER.add('initialize', 2)
+            return 'result'
+
+        background = SAPStartSrv.BackgroundCall(call)
+        assert background.result() == 'result'
+        # The phases are only added once
+        assert background.result() == 'result'
+        assert SAPStartSrv.TIMER.phases == {'initialize': 3}
+
+        background = SAPStartSrv.BackgroundCall(mock.Mock(side_effect=ValueError('error')))
+        with self.assertRaises(ValueError):
+            background.result()
+
+    def test_is_socket_listening(self):
+        socket_path = os.path.join(self._state_dir, 'socket')
+        assert SAPStartSrv.is_socket_listening(socket_path) is False
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(socket_path)
+            assert SAPStartSrv.is_socket_listening(socket_path) is False
+            server.listen(1)
+            assert SAPStartSrv.is_socket_listening(socket_path) is True
+        finally:
+            server.close()
+
+    @mock.patch('ocf.logger.warning')
+    def test_remove_stale_socket(self, mock_logger):
+        socket_path = os.path.join(self._state_dir, 'socket')
+        assert self._agent._remove_stale_socket(socket_path) is True
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(socket_path)
+            server.listen(1)
+            assert self._agent._remove_stale_socket(socket_path) is False
+            assert os.path.exists(socket_path)
+            mock_logger.assert_called_once_with(
+                '{} is in use by a running sapstartsrv, it is not removed'.format(socket_path))
+        finally:
+            server.close()
+
+        assert self._agent._remove_stale_socket(socket_path) is True
+        assert not os.path.exists(socket_path)
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('os.unlink')
+    @mock.patch('SAPStartSrv.is_socket_listening')
+    def test_remove_stale_socket_error(self, mock_is_socket_listening, mock_unlink, mock_logger):
+        mock_is_socket_listening.return_value = False
+        mock_unlink.side_effect = OSError(13, 'Permission denied')
+        assert self._agent._remove_stale_socket('/tmp/.sapstream50013') is True
+        mock_logger.assert_called_once_with(
+            'Cannot remove stale socket /tmp/.sapstream50013: [Errno 13] Permission denied')
+
+    def test_directory_watch(self):
+        with SAPStartSrv.DirectoryWatch(self._state_dir) as watch:
+            assert watch.fd is not None
+            open(os.path.join(self._state_dir, 'created'), 'w').close()
+            start = time.monotonic()
+            watch.wait(10)
+            assert time.monotonic() - start < 5
+        assert watch.fd is None
+
+    @mock.patch('time.sleep')
+    def test_directory_watch_unavailable(self, mock_sleep):
+        with SAPStartSrv.DirectoryWatch(os.path.join(self._state_dir, 'missing')) as watch:
+            assert watch.fd is None
+            watch.wait(0.5)
+            watch.wait(0)
+
+        mock_sleep.assert_called_once_with(0.5)
+
+    @mock.patch('SAPStartSrv.DirectoryWatch')
+    @mock.patch('SAPStartSrv.is_socket_listening')
+    @mock.patch('time.monotonic')
+    def test_wait_for_socket(self, mock_monotonic, mock_is_socket_listening, mock_watch):
+        self._agent.instance_number = '00'
+        watch = mock_watch.return_value.__enter__.return_value
+        mock_is_socket_listening.side_effect = [False, False, True]
+        mock_monotonic.side_effect = [10, 10.8]
+
+        assert self._agent._wait_for_socket(11) is True
+
+        mock_watch.assert_called_once_with('/tmp')
+        mock_is_socket_listening.assert_called_with('/tmp/.sapstream50013')
+        watch.wait.assert_has_calls([mock.call(0.5), mock.call(mock.ANY)])
+        assert round(watch.wait.call_args_list[1][0][0], 2) == 0.2
+
+    @mock.patch('SAPStartSrv.DirectoryWatch')
+    @mock.patch('SAPStartSrv.is_socket_listening')
+    @mock.patch('time.monotonic')
+    def test_wait_for_socket_timeout(self, mock_monotonic, mock_is_socket_listening, mock_watch):
+        self._agent.instance_number = '00'
+        mock_is_socket_listening.return_value = False
+        mock_monotonic.return_value = 12
+
+        assert self._agent._wait_for_socket(11) is False
+
+    @mock.patch('SAPStartSrv.DirectoryWatch')
+    @mock.patch('time.monotonic')
+    def test_wait_for_process(self, mock_monotonic, mock_watch):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        watch = mock_watch.return_value.__enter__.return_value
+        self._agent._get_status = mock.Mock(side_effect=[1, 1, 0])
+        mock_monotonic.side_effect = [0, 9.8]
+
+        assert self._agent._wait_for_process(10) is True
+
+        mock_watch.assert_called_once_with('/usr/sap/PRD/ASCS00/work', written=True)
+        watch.wait.assert_has_calls([mock.call(0.5), mock.call(mock.ANY)])
+        assert round(watch.wait.call_args_list[1][0][0], 2) == 0.2
+
+    @mock.patch('SAPStartSrv.DirectoryWatch')
+    @mock.patch('time.monotonic')
+    def test_wait_for_process_timeout(self, mock_monotonic, mock_watch):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        watch = mock_watch.return_value.__enter__.return_value
+        self._agent._get_status = mock.Mock(return_value=1)
+        mock_monotonic.side_effect = [0, 5]
+
+        assert self._agent._wait_for_process(5) is False
+
+        watch.wait.assert_called_once_with(0.5)
+        assert self._agent._get_status.call_count == 2
+
+    def test_directory_watch_written(self):
+        path = os.path.join(self._state_dir, 'sapstartsrv.pid')
+        with open(path, 'w') as pid_file:
+            pid_file.write('1234')
+        with SAPStartSrv.DirectoryWatch(self._state_dir, written=True) as watch:
+            with open(path, 'w') as pid_file:
+                pid_file.write('5678')
+            start = time.monotonic()
+            watch.wait(10)
+            assert time.monotonic() - start < 5
+
+    def test_read_pid_file(self):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+
+        with mock.patch('SAPStartSrv.open', mock.mock_open(read_data='1234\n'), create=True) as mock_file:
+            assert self._agent._read_pid_file() == 1234
+
+        mock_file.assert_called_once_with('/usr/sap/PRD/ASCS00/work/sapstartsrv.pid')
+
+    def test_read_pid_file_error(self):
+        with mock.patch('SAPStartSrv.open', mock.mock_open(read_data='garbage'), create=True):
+            assert self._agent._read_pid_file() is None
+
+        with mock.patch('SAPStartSrv.open', mock.Mock(side_effect=IOError), create=True):
+            assert self._agent._read_pid_file() is None
+
+    def test_match_process(self):
+        regex = SAPStartSrv.re.compile(r'pf=.*/PRD_ASCS00_virthost')
+
+        proc = mock.Mock()
+        proc.name.return_value = 'sapstartsrv'
+        proc.cmdline.return_value = [
+            'sapstartsrv', 'pf=/usr/sap/PRD/SYS/profile/PRD_ASCS00_virthost', '-D']
+        assert self._agent._match_process(proc, regex) is True
+
+        proc.cmdline.return_value = ['sapstartsrv', 'pf=/usr/sap/PRD/SYS/profile/PRD_ERS10_virt']
+        assert self._agent._match_process(proc, regex) is False
+
+        proc.name.return_value = 'bash'
+        assert self._agent._match_process(proc, regex) is False
+
+        proc.name.side_effect = psutil.NoSuchProcess(1)
+        assert self._agent._match_process(proc, regex) is False
+
+    @mock.patch('psutil.Process')
+    def test_find_process_by_pid_file(self, mock_process):
+        proc = mock.Mock()
+        mock_process.return_value = proc
+        self._agent._read_pid_file = mock.Mock(return_value=1234)
+        self._agent._match_process = mock.Mock(return_value=True)
+
+        assert self._agent._find_process_by_pid_file('regex') == proc
+
+        mock_process.assert_called_once_with(1234)
+        self._agent._match_process.assert_called_once_with(proc, 'regex')
+
+    @mock.patch('ocf.logger.debug')
+    @mock.patch('psutil.Process')
+    def test_find_process_by_pid_file_stale(self, mock_process, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        self._agent._read_pid_file = mock.Mock(return_value=1234)
+        self._agent._match_process = mock.Mock(return_value=False)
+
+        assert self._agent._find_process_by_pid_file('regex') is None
+
+        mock_logger.assert_called_once_with(
+            'Stale PID 1234 found in /usr/sap/PRD/ASCS00/work/sapstartsrv.pid')
+
+        mock_process.side_effect = psutil.NoSuchProcess(1234)
+        assert self._agent._find_process_by_pid_file('regex') is None
+
+        self._agent._read_pid_file = mock.Mock(return_value=None)
+        assert self._agent._find_process_by_pid_file('regex') is None
+
+    @mock.patch('psutil.process_iter')
+    def test_find_process_by_scan(self, mock_process_iter):
+        proc1 = mock.Mock(info={'name': 'bash'})
+        proc2 = mock.Mock(info={'name': 'sapstartsrv'})
+        proc3 = mock.Mock(info={'name': 'sapstartsrv'})
+        mock_process_iter.return_value = [proc1, proc2, proc3]
+        self._agent._match_process = mock.Mock(side_effect=[False, True])
+
+        assert self._agent._find_process_by_scan('regex') == proc3
+
+        mock_process_iter.assert_called_once_with(attrs=['name'])
+        self._agent._match_process.assert_has_calls([
+            mock.call(proc2, 'regex'),
+            mock.call(proc3, 'regex')
+        ])
+
+        mock_process_iter.return_value = [proc1]
+        assert self._agent._find_process_by_scan('regex') is None
+
+    def test_write_read_remove_state(self):
+        SAPStartSrv.write_state('PRD_ASCS00_virthost.pid', {'pid': 1234})
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') == {'pid': 1234}
+        assert os.listdir(self._state_dir) == ['PRD_ASCS00_virthost.pid']
+
+        SAPStartSrv.remove_state('PRD_ASCS00_virthost.pid')
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
+        SAPStartSrv.remove_state('PRD_ASCS00_virthost.pid')
+
+    @mock.patch('ocf.logger.warning')
+    def test_write_state_error(self, mock_logger):
+        with mock.patch('SAPStartSrv.STATE_DIR', '/dev/null/state'):
+            SAPStartSrv.write_state('file', {})
+
+        assert mock_logger.call_count == 1
+
+    def test_read_state_invalid(self):
+        with open(os.path.join(self._state_dir, 'file'), 'w') as state_file:
+            state_file.write('{invalid')
+
+        assert SAPStartSrv.read_state('file') is None
+
+    @mock.patch('psutil.Process')
+    def test_find_process_by_cache(self, mock_process):
+        SAPStartSrv.write_state(
+            'PRD_ASCS00_virthost.pid', {'pid': 1234, 'create_time': 10.5, 'profile': 'p'})
+        proc = mock.Mock()
+        proc.create_time.return_value = 10.5
+        mock_process.return_value = proc
+        self._agent._match_process = mock.Mock(return_value=True)
+
+        assert self._agent._find_process_by_cache('regex') == proc
+
+        mock_process.assert_called_once_with(1234)
+        self._agent._match_process.assert_called_once_with(proc, 'regex')
+
+    @mock.patch('ocf.logger.debug')
+    @mock.patch('psutil.Process')
+    def test_find_process_by_cache_pid_reused(self, mock_process, mock_logger):
+        SAPStartSrv.write_state(
+            'PRD_ASCS00_virthost.pid', {'pid': 1234, 'create_time': 10.5, 'profile': 'p'})
+        proc = mock.Mock()
+        proc.create_time.return_value = 20.0
+        mock_process.return_value = proc
+
+        assert self._agent._find_process_by_cache('regex') is None
+
+        mock_logger.assert_called_once_with(
+            'Cached sapstartsrv PID for PRD_ASCS00_virthost is not valid anymore')
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
+
+    @mock.patch('ocf.logger.debug')
+    @mock.patch('psutil.Process')
+    def test_find_process_by_cache_not_running(self, mock_process, mock_logger):
+        assert self._agent._find_process_by_cache('regex') is None
+        assert mock_process.call_count == 0
+
+        SAPStartSrv.write_state(
+            'PRD_ASCS00_virthost.pid', {'pid': 1234, 'create_time': 10.5, 'profile': 'p'})
+        mock_process.side_effect = psutil.NoSuchProcess(1234)
+
+        assert self._agent._find_process_by_cache('regex') is None
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
+
+    def test_update_pid_cache(self):
+        regex = SAPStartSrv.re.compile(r'pf=.*/PRD_ASCS00_virthost')
+        proc = mock.Mock(pid=1234)
+        proc.create_time.return_value = 10.5
+        proc.cmdline.return_value = [
+            'sapstartsrv', 'pf=/usr/sap/PRD/SYS/profile/PRD_ASCS00_virthost', '-D']
+
+        self._agent._update_pid_cache(proc, regex)
+
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') == {
+            'pid': 1234, 'create_time': 10.5,
+            'profile': '/usr/sap/PRD/SYS/profile/PRD_ASCS00_virthost'}
+
+        proc.cmdline.side_effect = psutil.NoSuchProcess(1234)
+        self._agent._invalidate_pid_cache()
+        self._agent._update_pid_cache(proc, regex)
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
+
+    @mock.patch('psutil.process_iter')
+    def test_build_process_index(self, mock_process_iter):
+        proc1 = mock.Mock(info={'name': 'bash'})
+        proc2 = mock.Mock(info={'name': 'sapstartsrv'}, pid=10)
+        proc2.cmdline.return_value = ['sapstartsrv', 'pf=/profile/PRD_ASCS00_virt', '-D']
+        proc2.create_time.return_value = 1.5
+        proc3 = mock.Mock(info={'name': 'sapstartsrv'}, pid=11)
+        proc3.cmdline.side_effect = psutil.NoSuchProcess(11)
+        proc4 = mock.Mock(info={'name': 'sapstartsrv'}, pid=12)
+        proc4.cmdline.return_value = ['sapstartsrv', 'pf=/profile/PRD_ERS10_virt']
+        proc4.create_time.return_value = 2.5
+        mock_process_iter.return_value = [proc1, proc2, proc3, proc4]
+
+        assert SAPStartSrv.build_process_index() == {
+            '/profile/PRD_ASCS00_virt': {'pid': 10, 'create_time': 1.5},
+            '/profile/PRD_ERS10_virt': {'pid': 12, 'create_time': 2.5}
+        }
+        assert proc1.cmdline.call_count == 0
+
+    @mock.patch('time.time')
+    @mock.patch('SAPStartSrv.build_process_index')
+    def test_load_process_snapshot(self, mock_build_process_index, mock_time):
+        mock_build_process_index.return_value = {'/profile': {'pid': 10, 'create_time': 1.5}}
+        mock_time.return_value = 100
+
+        assert SAPStartSrv.load_process_snapshot(2) == {'/profile': {'pid': 10, 'create_time': 1.5}}
+        assert SAPStartSrv.read_state('processes.snapshot') == {
+            'time': 100, 'processes': {'/profile': {'pid': 10, 'create_time': 1.5}}}
+
+        mock_time.return_value = 101.5
+        assert SAPStartSrv.load_process_snapshot(2) == {'/profile': {'pid': 10, 'create_time': 1.5}}
+        assert mock_build_process_index.call_count == 1
+
+        mock_build_process_index.return_value = {}
+        mock_time.return_value = 102
+        assert SAPStartSrv.load_process_snapshot(2) == {}
+        assert mock_build_process_index.call_count == 2
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.build_process_index')
+    def test_load_process_snapshot_lock_error(self, mock_build_process_index, mock_logger):
+        mock_build_process_index.return_value = {}
+
+        with mock.patch('SAPStartSrv.STATE_DIR', '/dev/null/state'):
+            assert SAPStartSrv.load_process_snapshot(2) == {}
+
+        assert mock_logger.call_count == 1
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.build_process_index')
+    def test_load_process_snapshot_locked(self, mock_build_process_index, mock_logger):
+        import fcntl
+        mock_build_process_index.return_value = {'/profile': {'pid': 10, 'create_time': 1.5}}
+        SAPStartSrv.write_state('processes.snapshot', {'time': time.time(), 'processes': {}})
+
+        # A hung lock holder does not block the probe, it scans the process table itself
+        with open(os.path.join(SAPStartSrv.STATE_DIR, 'processes.snapshot.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with mock.patch('SAPStartSrv.SNAPSHOT_LOCK_TIMEOUT', 0.1):
+                assert SAPStartSrv.load_process_snapshot(2) == {
+                    '/profile': {'pid': 10, 'create_time': 1.5}}
+
+        assert mock_logger.call_count == 1
+        assert SAPStartSrv.read_state('processes.snapshot')['processes'] == {}
+
+    @mock.patch('time.sleep')
+    @mock.patch('fcntl.flock')
+    def test_lock_snapshot(self, mock_flock, mock_sleep):
+        mock_flock.side_effect = [BlockingIOError(), None]
+        assert SAPStartSrv.lock_snapshot('lock_file') is True
+        assert mock_flock.call_count == 2
+        assert mock_sleep.call_count == 1
+
+        mock_flock.side_effect = BlockingIOError()
+        with mock.patch('SAPStartSrv.SNAPSHOT_LOCK_TIMEOUT', 0):
+            assert SAPStartSrv.lock_snapshot('lock_file') is False
+
+    @mock.patch('ocf.get_parameter')
+    def test_get_snapshot_ttl(self, mock_get_parameter):
+        mock_get_parameter.return_value = '1.5'
+        assert self._agent._get_snapshot_ttl() == 1.5
+        mock_get_parameter.assert_called_once_with('PROBE_SNAPSHOT_TTL', '0')
+
+        mock_get_parameter.return_value = '-1'
+        assert self._agent._get_snapshot_ttl() == 0
+
+        mock_get_parameter.return_value = 'invalid'
+        assert self._agent._get_snapshot_ttl() == 0
+
+    @mock.patch('psutil.Process')
+    def test_find_process_in_index(self, mock_process):
+        regex = SAPStartSrv.re.compile(r'pf=.*/PRD_ASCS00_virthost')
+        index = {
+            '/profile/PRD_ERS10_virthost': {'pid': 10, 'create_time': 1.5},
+            '/profile/PRD_ASCS00_virthost': {'pid': 11, 'create_time': 2.5}
+        }
+        proc = mock.Mock()
+        proc.create_time.return_value = 2.5
+        mock_process.return_value = proc
+
+        assert self._agent._find_process_in_index(index, regex) == proc
+        mock_process.assert_called_once_with(11)
+
+        proc.create_time.return_value = 3.5
+        assert self._agent._find_process_in_index(index, regex) is None
+
+        mock_process.side_effect = psutil.NoSuchProcess(11)
+        assert self._agent._find_process_in_index(index, regex) is None
+
+    @mock.patch('SAPStartSrv.load_process_snapshot')
+    @mock.patch('ocf.is_probe')
+    def test_find_process_snapshot(self, mock_is_probe, mock_load_process_snapshot):
+        mock_is_probe.return_value = True
+        mock_load_process_snapshot.return_value = 'index'
+        self._agent._find_process_by_cache = mock.Mock(return_value=None)
+        self._agent._find_process_by_pid_file = mock.Mock(return_value=None)
+        self._agent._find_process_by_scan = mock.Mock()
+        self._agent._get_snapshot_ttl = mock.Mock(return_value=2)
+        self._agent._find_process_in_index = mock.Mock(return_value='proc')
+        self._agent._update_pid_cache = mock.Mock()
+
+        assert self._agent._find_process() == 'proc'
+
+        mock_load_process_snapshot.assert_called_once_with(2)
+        self._agent._find_process_in_index.assert_called_once_with('index', mock.ANY)
+        assert self._agent._find_process_by_scan.call_count == 0
+
+        mock_is_probe.return_value = False
+        self._agent._find_process_by_scan.return_value = 'scanned'
+
+        assert self._agent._find_process() == 'scanned'
+        assert mock_load_process_snapshot.call_count == 1
+
+    def _serve_helper_answer(self, answer):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._helper_socket)
+        server.listen(1)
+
+        def serve():
+            connection = server.accept()[0]
+            self._helper_request = connection.recv(64)
+            connection.sendall(answer)
+            connection.close()
+            server.close()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_query_index_helper(self):
+        assert SAPStartSrv.query_index_helper() is None
+
+        thread = self._serve_helper_answer(
+            b'{"live": true, "processes": {"/usr/sap/PRD/SYS/profile/PRD_ASCS00_virthost": '
+            b'{"pid": 10, "create_time": 5.5, "unit": "SAPPRD_00.service"}}}\n')
+        assert SAPStartSrv.query_index_helper() == {
+            'live': True, 'processes': {'/usr/sap/PRD/SYS/profile/PRD_ASCS00_virthost': {
+                'pid': 10, 'create_time': 5.5, 'unit': 'SAPPRD_00.service'}}}
+        assert self._helper_request == b'INDEX\n'
+        thread.join()
+
+    @mock.patch('ocf.logger.debug')
+    def test_query_index_helper_error(self, mock_logger):
+        thread = self._serve_helper_answer(b'{"error": "unknown request"}\n')
+        assert SAPStartSrv.query_index_helper() is None
+        mock_logger.assert_called_once_with(
+            'sapstartsrv-index helper returned an invalid index')
+        thread.join()
+        os.unlink(self._helper_socket)
+
+        thread = self._serve_helper_answer(b'{"live": tr')
+        assert SAPStartSrv.query_index_helper() is None
+        thread.join()
+        os.unlink(self._helper_socket)
+
+        # Stale socket of a stopped helper
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self._helper_socket)
+        stale.close()
+        mock_logger.reset_mock()
+        assert SAPStartSrv.query_index_helper() is None
+        mock_logger.assert_called_once_with(mock.ANY)
+
+    @mock.patch('SAPStartSrv.query_index_helper')
+    def test_find_process_by_helper(self, mock_query_index_helper):
+        self._agent._find_process_in_index = mock.Mock(return_value=None)
+
+        mock_query_index_helper.return_value = None
+        assert self._agent._find_process_by_helper('regex') == (None, False)
+        assert self._agent._find_process_in_index.call_count == 0
+
+        mock_query_index_helper.return_value = {'live': False, 'processes': 'index'}
+        assert self._agent._find_process_by_helper('regex') == (None, False)
+        self._agent._find_process_in_index.assert_called_with('index', 'regex')
+
+        mock_query_index_helper.return_value = {'live': True, 'processes': 'index'}
+        assert self._agent._find_process_by_helper('regex') == (None, True)
+
+        mock_query_index_helper.return_value = {'live': False, 'processes': 'index'}
+        self._agent._find_process_in_index.return_value = 'proc'
+        assert self._agent._find_process_by_helper('regex') == ('proc', True)
+
+    @mock.patch('os.path.exists')
+    def test_find_process_by_unit_sys5(self, mock_exists):
+        self._agent._get_unit_properties = mock.Mock()
+
+        assert self._agent._find_process_by_unit('regex') == (None, False)
+        assert mock_exists.call_count == 0
+
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        mock_exists.return_value = False
+        assert self._agent._find_process_by_unit('regex') == (None, False)
+        mock_exists.assert_called_once_with('/etc/systemd/system/SAPPRD_00.service')
+        assert self._agent._get_unit_properties.call_count == 0
+
+    @mock.patch('psutil.Process')
+    @mock.patch('os.path.exists')
+    def test_find_process_by_unit(self, mock_exists, mock_process):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        mock_exists.return_value = True
+        self._agent._get_unit_properties = mock.Mock(return_value=None)
+        self._agent._match_process = mock.Mock(return_value=True)
+        proc = mock.Mock(pid=1234)
+        mock_process.return_value = proc
+
+        assert self._agent._find_process_by_unit('regex') == (None, False)
+
+        self._agent._get_unit_properties.return_value = {'LoadState': 'not-found'}
+        assert self._agent._find_process_by_unit('regex') == (None, False)
+
+        self._agent._get_unit_properties.return_value = {
+            'LoadState': 'loaded', 'ActiveState': 'inactive', 'MainPID': '0'}
+        assert self._agent._find_process_by_unit('regex') == (None, True)
+
+        self._agent._get_unit_properties.return_value = {
+            'LoadState': 'loaded', 'ActiveState': 'activating', 'MainPID': '1234'}
+        assert self._agent._find_process_by_unit('regex') == (None, False)
+
+        self._agent._get_unit_properties.return_value = {
+            'LoadState': 'loaded', 'ActiveState': 'active', 'MainPID': '0'}
+        assert self._agent._find_process_by_unit('regex') == (None, False)
+        assert mock_process.call_count == 0
+
+        self._agent._get_unit_properties.return_value = {
+            'LoadState': 'loaded', 'ActiveState': 'active', 'MainPID': '1234'}
+        assert self._agent._find_process_by_unit('regex') == (proc, True)
+        mock_process.assert_called_once_with(1234)
+        self._agent._match_process.assert_called_once_with(proc, 'regex')
+
+        self._agent._match_process.return_value = False
+        assert self._agent._find_process_by_unit('regex') == (None, False)
+
+    @mock.patch('ocf.is_probe')
+    def test_find_process_unit(self, mock_is_probe):
+        mock_is_probe.return_value = False
+        self._agent._find_process_by_cache = mock.Mock(return_value=None)
+        self._agent._find_process_by_pid_file = mock.Mock(return_value=None)
+        self._agent._find_process_by_unit = mock.Mock(return_value=(None, True))
+        self._agent._find_process_by_helper = mock.Mock()
+        self._agent._find_process_by_scan = mock.Mock(return_value='scanned')
+        self._agent._update_pid_cache = mock.Mock()
+
+        assert self._agent._find_process() is None
+        assert self._agent._find_process_by_helper.call_count == 0
+        assert self._agent._find_process_by_scan.call_count == 0
+
+        self._agent._find_process_by_unit.return_value = ('proc', True)
+        assert self._agent._find_process() == 'proc'
+        self._agent._update_pid_cache.assert_called_once_with('proc', mock.ANY)
+
+        self._agent._find_process_by_unit.return_value = (None, False)
+        self._agent._find_process_by_helper.return_value = (None, False)
+        assert self._agent._find_process() == 'scanned'
+
+    @mock.patch('ocf.is_probe')
+    def test_find_process_helper(self, mock_is_probe):
+        mock_is_probe.return_value = False
+        self._agent._find_process_by_cache = mock.Mock(return_value=None)
+        self._agent._find_process_by_pid_file = mock.Mock(return_value=None)
+        self._agent._find_process_by_unit = mock.Mock(return_value=(None, False))
+        self._agent._find_process_by_helper = mock.Mock(return_value=(None, True))
+        self._agent._find_process_by_scan = mock.Mock(return_value='scanned')
+        self._agent._update_pid_cache = mock.Mock()
+
+        assert self._agent._find_process() is None
+        assert self._agent._find_process_by_scan.call_count == 0
+
+        self._agent._find_process_by_helper.return_value = ('proc', True)
+        assert self._agent._find_process() == 'proc'
+        self._agent._update_pid_cache.assert_called_once_with('proc', mock.ANY)
+
+        self._agent._find_process_by_helper.return_value = (None, False)
+        assert self._agent._find_process() == 'scanned'
+
+    def test_find_process_shared_index(self):
+        self._agent.process_index = 'index'
+        self._agent._find_process_by_cache = mock.Mock(return_value=None)
+        self._agent._find_process_by_pid_file = mock.Mock(return_value=None)
+        self._agent._find_process_by_scan = mock.Mock(return_value=None)
+        self._agent._find_process_in_index = mock.Mock(return_value=None)
+        self._agent._update_pid_cache = mock.Mock()
+
+        assert self._agent._find_process() is None
+        self._agent._find_process_in_index.assert_called_once_with('index', mock.ANY)
+        assert self._agent._find_process_by_scan.call_count == 0
+        assert self._agent.process_index is None
+
+        # The shared index is only used once, e.g. a start waiting for the new process
+        assert self._agent._find_process() is None
+        assert self._agent._find_process_in_index.call_count == 1
+        assert self._agent._find_process_by_scan.call_count == 1
+
+    def test_find_process_cached(self):
+        self._agent._find_process_by_cache = mock.Mock(return_value='cached')
+        self._agent._find_process_by_pid_file = mock.Mock()
+        self._agent._update_pid_cache = mock.Mock()
+
+        assert self._agent._find_process() == 'cached'
+        assert self._agent._find_process_by_pid_file.call_count == 0
+        assert self._agent._update_pid_cache.call_count == 0
+
+    @mock.patch('ocf.is_probe')
+    def test_find_process(self, mock_is_probe):
+        mock_is_probe.return_value = False
+        self._agent._find_process_by_cache = mock.Mock(return_value=None)
+        self._agent._find_process_by_pid_file = mock.Mock(return_value='proc')
+        self._agent._find_process_by_scan = mock.Mock()
+        self._agent._update_pid_cache = mock.Mock()
+
+        assert self._agent._find_process() == 'proc'
+        assert self._agent._find_process_by_scan.call_count == 0
+        self._agent._update_pid_cache.assert_called_once_with('proc', mock.ANY)
+
+        self._agent._update_pid_cache.reset_mock()
+        self._agent._find_process_by_pid_file = mock.Mock(return_value=None)
+        self._agent._find_process_by_scan = mock.Mock(return_value='scanned')
+
+        assert self._agent._find_process() == 'scanned'
+        self._agent._update_pid_cache.assert_called_once_with('scanned', mock.ANY)
+
+        self._agent._update_pid_cache.reset_mock()
+        self._agent._find_process_by_scan = mock.Mock(return_value=None)
+
+        assert self._agent._find_process() is None
+        assert self._agent._update_pid_cache.call_count == 0
+
+    @mock.patch('ocf.logger.info')
+    def test_get_status(self, mock_logger):
+        proc = mock.Mock(pid=1234)
+        proc.ppid.return_value = 1
+        proc.cmdline.return_value = ['sapstartsrv', 'pf=profile']
+        self._agent._find_process = mock.Mock(return_value=proc)
+
+        assert self._agent._get_status() == 0
+
+        mock_logger.assert_called_once_with(
+            'Current status: 0. Output: Found running sapstartsrv process - '
+            'PID:1234 PPID:1 CMDLINE:[\'sapstartsrv\', \'pf=profile\']')
+
+    @mock.patch('ocf.logger.info')
+    def test_get_status_not_running(self, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        self._agent.virtual_host = 'virthost'
+        self._agent.saptstartsrv_path = '/mock/sapstartsrv'
+        self._agent._find_process = mock.Mock(return_value=None)
+
+        assert self._agent._get_status() == 1
+
+        mock_logger.assert_called_once_with(
+            'Current status: 1. Output: No running sapstartsrv process found for '
+            '/mock/sapstartsrv with pf=.*/PRD_ASCS00_virthost')
+
+    @mock.patch('SAPStartSrv.run_command')
+    def test_query_unit_properties(self, mock_run_command):
+        mock_run_command.return_value = command_result(
+            returncode=0,
+            output='LoadState=loaded\nActiveState=active\nUnitFileState=enabled\n'
+                   'MainPID=1234\n\n'
+                   'LoadState=not-found\nActiveState=inactive\nUnitFileState=\nMainPID=0\n')
+
+        result = SAPStartSrv.query_unit_properties(['SAPPRD_00.service', 'SAPPRD_10.service'])
+        assert result == {
+            'SAPPRD_00.service': {
+                'LoadState': 'loaded', 'ActiveState': 'active', 'UnitFileState': 'enabled',
+                'MainPID': '1234'},
+            'SAPPRD_10.service': {
+                'LoadState': 'not-found', 'ActiveState': 'inactive', 'UnitFileState': '',
+                'MainPID': '0'}
+        }
+
+        mock_run_command.assert_called_once_with(
+            '/usr/bin/systemctl show -p LoadState,ActiveState,UnitFileState,MainPID '
+            'SAPPRD_00.service SAPPRD_10.service')
+
+    @mock.patch('SAPStartSrv.run_command')
+    def test_query_unit_properties_error(self, mock_run_command):
+        mock_run_command.return_value = command_result(returncode=1, output='')
+        assert SAPStartSrv.query_unit_properties(['SAPPRD_00.service']) is None
+
+        mock_run_command.return_value = command_result(returncode=0, output='LoadState=loaded\n')
+        assert SAPStartSrv.query_unit_properties(
+            ['SAPPRD_00.service', 'SAPPRD_10.service']) is None
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_query_unit_properties_timeout(self, mock_run_command, mock_logger):
+        mock_run_command.return_value = command_result(returncode=124, timed_out=True)
+        assert SAPStartSrv.query_unit_properties(['SAPPRD_00.service']) is None
+        mock_logger.assert_called_once_with(
+            'systemctl show SAPPRD_00.service timed out, killed at the action deadline')
+
+    @mock.patch('SAPStartSrv.query_unit_properties')
+    def test_get_unit_properties(self, mock_query_unit_properties):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        mock_query_unit_properties.return_value = {
+            'SAPPRD_00.service': {'LoadState': 'loaded'}}
+
+        assert self._agent._get_unit_properties() == {'LoadState': 'loaded'}
+        assert self._agent._get_unit_properties() == {'LoadState': 'loaded'}
+        mock_query_unit_properties.assert_called_once_with(['SAPPRD_00.service'])
+
+    @mock.patch('SAPStartSrv.query_unit_properties')
+    def test_get_unit_properties_error(self, mock_query_unit_properties):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        mock_query_unit_properties.return_value = None
+
+        assert self._agent._get_unit_properties() is None
+        assert self._agent._get_unit_properties() is None
+        mock_query_unit_properties.assert_called_once_with(['SAPPRD_00.service'])
+
+    @mock.patch('SAPStartSrv.run_command')
+    def test_is_unit_active_properties(self, mock_run_command):
+        self._agent._get_unit_properties = mock.Mock(return_value={'ActiveState': 'active'})
+        assert self._agent._is_unit_active() is True
+
+        self._agent._get_unit_properties = mock.Mock(return_value={'ActiveState': 'failed'})
+        assert self._agent._is_unit_active() is False
+
+        assert mock_run_command.call_count == 0
+
+    @mock.patch('ocf.have_binary')
+    @mock.patch('os.path.exists')
+    def test_chk_systemd_support_properties(self, mock_exists, mock_have_binary):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        mock_have_binary.return_value = True
+        mock_exists.return_value = False
+        self._agent._get_systemd_unit = mock.Mock()
+
+        self._agent._get_unit_properties = mock.Mock(return_value={'LoadState': 'loaded'})
+        assert self._agent._chk_systemd_support() is True
+
+        self._agent._get_unit_properties = mock.Mock(return_value={'LoadState': 'not-found'})
+        assert self._agent._chk_systemd_support() is False
+
+        assert self._agent._get_systemd_unit.call_count == 0
+
     @mock.patch('SAPStartSrv.run_command')
     def test_is_unit_active(self, mock_run_command):
-        mock_result = mock.Mock(output='output', returncode=0)
+        mock_result = command_result(output='output', returncode=0)
         mock_run_command.return_value = mock_result
         self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent._get_unit_properties = mock.Mock(return_value=None)
 
         result = self._agent._is_unit_active()
         assert result is True
@@ -120,9 +1413,10 @@ class TestSAPStartSrv(unittest.TestCase):
 
     @mock.patch('SAPStartSrv.run_command')
     def test_is_unit_not_active(self, mock_run_command):
-        mock_result = mock.Mock(output='output', returncode=1)
+        mock_result = command_result(output='output', returncode=1)
         mock_run_command.return_value = mock_result
         self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent._get_unit_properties = mock.Mock(return_value=None)
 
         result = self._agent._is_unit_active()
         assert result is False
@@ -131,7 +1425,7 @@ class TestSAPStartSrv(unittest.TestCase):
 
     @mock.patch('SAPStartSrv.run_command')
     def test_get_systemd_unit_success(self, mock_run_command):
-        mock_result = mock.Mock(output='UNIT FILE    STATE  \nSAPPRD_00.service\n\n1 unit files listed.\n', returncode=0)
+        mock_result = command_result(output='UNIT FILE    STATE  \nSAPPRD_00.service\n\n1 unit files listed.\n', returncode=0)
         mock_run_command.return_value = mock_result
         self._agent.systemd_unit_name = 'SAPPRD_00.service'
 
@@ -142,7 +1436,7 @@ class TestSAPStartSrv(unittest.TestCase):
 
     @mock.patch('SAPStartSrv.run_command')
     def test_get_systemd_unit_error(self, mock_run_command):
-        mock_result = mock.Mock(output='output', returncode=1)
+        mock_result = command_result(output='output', returncode=1)
         mock_run_command.return_value = mock_result
         self._agent.systemd_unit_name = 'SAPPRD_00.service'
 
@@ -164,6 +1458,8 @@ class TestSAPStartSrv(unittest.TestCase):
         get_systemd_unit_mock = mock.Mock(return_value=False)
         self._agent._get_systemd_unit = get_systemd_unit_mock
 
+        self._agent._get_unit_properties = mock.Mock(return_value=None)
+
         result = self._agent._chk_systemd_support()
         assert result is False
 
@@ -219,6 +1515,8 @@ class TestSAPStartSrv(unittest.TestCase):
         get_systemd_unit_mock = mock.Mock(return_value=False)
         self._agent._get_systemd_unit = get_systemd_unit_mock
 
+        self._agent._get_unit_properties = mock.Mock(return_value=None)
+
         result = self._agent._chk_systemd_support()
         assert result is False
 
@@ -242,6 +1540,8 @@ class TestSAPStartSrv(unittest.TestCase):
         get_systemd_unit_mock = mock.Mock(return_value=True)
         self._agent._get_systemd_unit = get_systemd_unit_mock
 
+        self._agent._get_unit_properties = mock.Mock(return_value=None)
+
         result = self._agent._chk_systemd_support()
         assert result is True
 
@@ -384,6 +1684,93 @@ class TestSAPStartSrv(unittest.TestCase):
                 'Cannot find sapstartsrv and sapcontrol executable in /usr/sap/PRD/ASCS00/exe/run')
         ])
 
+    def _create_executables(self, directory):
+        os.makedirs(directory)
+        for name in ('sapstartsrv', 'sapcontrol'):
+            open(os.path.join(directory, name), 'w').close()
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.have_binary')
+    @mock.patch('ocf.get_parameter')
+    def test_find_executables_cached(self, mock_get_parameter, mock_have_binary):
+        exe_dir = os.path.join(self._state_dir, 'exe')
+        self._create_executables(exe_dir)
+        mock_get_parameter.return_value = exe_dir
+        mock_have_binary.return_value = True
+
+        assert self._agent._find_executables() == 0
+        assert mock_have_binary.call_count == 2
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.executables')['dir_executable'] == exe_dir
+
+        self._agent = SAPStartSrv.SapStartSrv('PRD_ASCS00_virthost')
+        assert self._agent._find_executables() == 0
+        assert mock_have_binary.call_count == 2
+        assert self._agent.dir_executable == exe_dir
+        assert self._agent.saptstartsrv_path == '{}/sapstartsrv'.format(exe_dir)
+        assert self._agent.sapcontrol_path == '{}/sapcontrol'.format(exe_dir)
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.have_binary')
+    @mock.patch('ocf.get_parameter')
+    def test_find_executables_cache_parameter_changed(self, mock_get_parameter, mock_have_binary):
+        exe_dir = os.path.join(self._state_dir, 'exe')
+        self._create_executables(exe_dir)
+        mock_get_parameter.return_value = exe_dir
+        mock_have_binary.return_value = True
+        assert self._agent._find_executables() == 0
+
+        other_dir = os.path.join(self._state_dir, 'other')
+        self._create_executables(other_dir)
+        mock_get_parameter.return_value = other_dir
+        assert self._agent._find_executables() == 0
+        assert mock_have_binary.call_count == 4
+        assert self._agent.dir_executable == other_dir
+
+    @mock.patch('ocf.logger.info')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.have_binary')
+    @mock.patch('ocf.get_parameter')
+    def test_find_executables_cache_disappeared(
+            self, mock_get_parameter, mock_have_binary, mock_logger):
+        exe_dir = os.path.join(self._state_dir, 'exe')
+        self._create_executables(exe_dir)
+        mock_get_parameter.return_value = exe_dir
+        mock_have_binary.return_value = True
+        assert self._agent._find_executables() == 0
+
+        os.remove(os.path.join(exe_dir, 'sapcontrol'))
+        self._agent._search_executables = mock.Mock(return_value=1)
+        assert self._agent._find_executables() == 1
+
+        self._agent._search_executables.assert_called_once_with(exe_dir)
+        mock_logger.assert_called_once_with(
+            'Cached executables in {} are not available anymore'.format(exe_dir))
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.executables') is None
+
+    @mock.patch('ocf.have_binary')
+    def test_load_executables_cache_replaced(self, mock_have_binary):
+        exe_dir = os.path.join(self._state_dir, 'exe')
+        self._create_executables(exe_dir)
+        self._agent.dir_executable = exe_dir
+        self._agent.saptstartsrv_path = '{}/sapstartsrv'.format(exe_dir)
+        self._agent.sapcontrol_path = '{}/sapcontrol'.format(exe_dir)
+        self._agent._save_executables_cache(None)
+
+        os.remove(self._agent.sapcontrol_path)
+        open(self._agent.sapcontrol_path, 'w').close()
+        os.utime(self._agent.sapcontrol_path, (0, 0))
+        mock_have_binary.return_value = True
+
+        assert self._agent._load_executables_cache(None) is True
+        assert mock_have_binary.call_count == 2
+        cache = SAPStartSrv.read_state('PRD_ASCS00_virthost.executables')
+        assert cache['binaries'][self._agent.sapcontrol_path][1] == 0
+
+        os.utime(self._agent.sapcontrol_path, (1, 1))
+        mock_have_binary.return_value = False
+        assert self._agent._load_executables_cache(None) is False
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.executables') is None
+
     @mock.patch('ocf.get_parameter')
     def test_export_variables(self, mock_get_parameter):
 
@@ -398,9 +1785,10 @@ class TestSAPStartSrv(unittest.TestCase):
         with mock.patch.dict(os.environ, test_dict):
             self._agent._export_variables()
 
-            assert os.environ['OCF_RESKEY_START_WAITTIME'] == '1234'
-            assert os.environ['OCF_RESKEY_MONITOR_SERVICES'] == 'services'
-            assert os.environ['LD_LIBRARY_PATH'] == '/mydir'
+            assert self._agent.environment['OCF_RESKEY_START_WAITTIME'] == '1234'
+            assert self._agent.environment['OCF_RESKEY_MONITOR_SERVICES'] == 'services'
+            assert self._agent.environment['LD_LIBRARY_PATH'] == '/mydir'
+            assert os.environ['LD_LIBRARY_PATH'] == ''
 
         assert mock_get_parameter.call_count == 0
 
@@ -410,7 +1798,7 @@ class TestSAPStartSrv(unittest.TestCase):
         test_dict = {
             'OCF_RESKEY_START_WAITTIME': '',
             'OCF_RESKEY_MONITOR_SERVICES': '',
-            'LD_LIBRARY_PATH': '/folder1:/folder2:/folder3'
+            'LD_LIBRARY_PATH': '/folder1:/mydir/run:/folder3'
         }
 
         self._agent.dir_executable = '/mydir'
@@ -419,18 +1807,36 @@ class TestSAPStartSrv(unittest.TestCase):
         with mock.patch.dict(os.environ, test_dict):
             self._agent._export_variables()
 
-            assert os.environ['OCF_RESKEY_START_WAITTIME'] == '1234'
-            assert os.environ['OCF_RESKEY_MONITOR_SERVICES'] == 'new-services'
-            assert os.environ['LD_LIBRARY_PATH'] == '/folder1:/folder2:/folder3:/mydir'
+            assert self._agent.environment['OCF_RESKEY_START_WAITTIME'] == '1234'
+            assert self._agent.environment['OCF_RESKEY_MONITOR_SERVICES'] == 'new-services'
+            assert self._agent.environment['LD_LIBRARY_PATH'] == \
+                '/folder1:/mydir/run:/folder3:/mydir'
+            # The agent environment is shared by the instances of a MultiSapStartSrv
+            assert os.environ['OCF_RESKEY_START_WAITTIME'] == ''
+            assert os.environ['LD_LIBRARY_PATH'] == '/folder1:/mydir/run:/folder3'
 
         mock_get_parameter.assert_has_calls([
             mock.call('START_WAITTIME', '3600'),
             mock.call('MONITOR_SERVICES', SAPStartSrv.MONITOR_SERVICES_DEFAULT)
         ])
 
+    @mock.patch('ocf.get_parameter')
+    def test_export_variables_instances(self, mock_get_parameter):
+        mock_get_parameter.side_effect = lambda name, default=None: default
+        other = SAPStartSrv.SapStartSrv('PRD_ERS10_virthost2')
+        self._agent.dir_executable = '/usr/sap/PRD/ASCS00/exe'
+        other.dir_executable = '/usr/sap/PRD/ERS10/exe'
+
+        with mock.patch.dict(os.environ, {'LD_LIBRARY_PATH': '/lib'}):
+            self._agent._export_variables()
+            other._export_variables()
+
+        assert self._agent.environment['LD_LIBRARY_PATH'] == '/lib:/usr/sap/PRD/ASCS00/exe'
+        assert other.environment['LD_LIBRARY_PATH'] == '/lib:/usr/sap/PRD/ERS10/exe'
+
     @mock.patch('ocf.get_parameter')
     @mock.patch('ocf.OCF_SUCCESS', 0)
-    def test_initialize_success(self, mock_get_parameter):
+    def test_prepare_environment_profile(self, mock_get_parameter):
         sid = 'PRD'
         instance_name = 'ASCS'
         instance_number = '00'
@@ -445,7 +1851,8 @@ class TestSAPStartSrv(unittest.TestCase):
         mock_param2 = 'myprofile'
         mock_get_parameter.side_effect = [dir_profile, mock_param2]
 
-        ocf_returncode = self._agent._inititialize()
+        assert self._agent._parse_instance_name() == 0
+        ocf_returncode = self._agent._prepare_environment()
         assert ocf_returncode == 0
 
         assert self._agent.sid == sid
@@ -465,7 +1872,7 @@ class TestSAPStartSrv(unittest.TestCase):
         self._agent._export_variables.assert_called_once_with()
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
-    def test_initialize_error(self):
+    def test_prepare_environment_error(self):
         sid = 'PRD'
         instance_name = 'ASCS'
         instance_number = '00'
@@ -475,7 +1882,8 @@ class TestSAPStartSrv(unittest.TestCase):
 
         self._agent._find_executables = mock.Mock(return_value=1)
 
-        ocf_returncode = self._agent._inititialize()
+        assert self._agent._parse_instance_name() == 0
+        ocf_returncode = self._agent._prepare_environment()
         assert ocf_returncode == 1
 
         assert self._agent.sid == sid
@@ -488,10 +1896,10 @@ class TestSAPStartSrv(unittest.TestCase):
 
     @mock.patch('ocf.logger.error')
     @mock.patch('ocf.OCF_ERR_ARGS', 1)
-    def test_initialize_validation_error(self, mock_logger):
+    def test_parse_instance_name_error(self, mock_logger):
         self._agent = SAPStartSrv.SapStartSrv('ASCS')
 
-        ocf_returncode = self._agent._inititialize()
+        ocf_returncode = self._agent._parse_instance_name()
         assert ocf_returncode == 1
 
         mock_logger.assert_called_once_with(
@@ -500,7 +1908,7 @@ class TestSAPStartSrv(unittest.TestCase):
         mock_logger.reset_mock()
         self._agent = SAPStartSrv.SapStartSrv('PRD_ASCS')
 
-        ocf_returncode = self._agent._inititialize()
+        ocf_returncode = self._agent._parse_instance_name()
         assert ocf_returncode == 1
 
         mock_logger.assert_called_once_with(
@@ -509,7 +1917,7 @@ class TestSAPStartSrv(unittest.TestCase):
         mock_logger.reset_mock()
         self._agent = SAPStartSrv.SapStartSrv('PRD_ASCS00')
 
-        ocf_returncode = self._agent._inititialize()
+        ocf_returncode = self._agent._parse_instance_name()
         assert ocf_returncode == 1
 
         mock_logger.assert_called_once_with(
@@ -518,25 +1926,147 @@ class TestSAPStartSrv(unittest.TestCase):
         mock_logger.reset_mock()
         self._agent = SAPStartSrv.SapStartSrv('PRD_ASCS_virthost')
 
-        ocf_returncode = self._agent._inititialize()
-        assert ocf_returncode == 1
+        ocf_returncode = self._agent._parse_instance_name()
+        assert ocf_returncode == 1
+
+        mock_logger.assert_called_once_with(
+            'InstanceName parsing error. It must follow SID_NAME00_VIRTHOST syntax')
+
+        mock_logger.reset_mock()
+        self._agent = SAPStartSrv.SapStartSrv('PRD_ASCS_')
+
+        ocf_returncode = self._agent._parse_instance_name()
+        assert ocf_returncode == 1
+
+        mock_logger.assert_called_once_with(
+            'InstanceName parsing error. It must follow SID_NAME00_VIRTHOST syntax')
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    def test_parse_instance_name(self):
+        assert self._agent._parse_instance_name() == 0
+
+        assert self._agent.sid == 'PRD'
+        assert self._agent.instance_name == 'ASCS00'
+        assert self._agent.instance_number == '00'
+        assert self._agent.virtual_host == 'virthost'
+        assert self._agent.sidadm == 'prdadm'
+        assert self._agent.systemd_unit_name == 'SAPPRD_00.service'
+
+        self._agent.full_name = 'QAS_ERS10_other'
+        assert self._agent._parse_instance_name() == 0
+        assert self._agent.sid == 'PRD'
+
+    @mock.patch('ocf.get_parameter')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    def test_prepare_environment(self, mock_get_parameter):
+        self._agent._parse_instance_name()
+        self._agent._find_executables = mock.Mock(return_value=0)
+        self._agent._export_variables = mock.Mock()
+        mock_get_parameter.side_effect = ['dir_profile', 'myprofile']
+
+        assert self._agent._prepare_environment() == 0
+        assert self._agent._prepare_environment() == 0
+
+        assert self._agent.sap_instance_profile == 'myprofile'
+        self._agent._find_executables.assert_called_once_with()
+        self._agent._export_variables.assert_called_once_with()
+
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    @mock.patch('SAPStartSrv.run_command')
+    def test_stop_sapcontrol_not_found(self, mock_run_command, mock_logger):
+        self._agent._parse_instance_name()
+        self._agent._get_status = mock.Mock(return_value=0)
+        self._agent._stop_service_native = mock.Mock(return_value=False)
+        self._agent._prepare_environment = mock.Mock(return_value=5)
+
+        assert self._agent.stop() == 1
+
+        assert mock_run_command.call_count == 0
+        mock_logger.assert_called_once_with(
+            'SAP Instance PRD_ASCS00 stop failed: sapcontrol not found')
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.OCF_ERR_ARGS', 2)
+    def test_validate_parse_error(self):
+        self._agent._parse_instance_name = mock.Mock(return_value=2)
+
+        assert self._agent.validate() == 2
+
+    @mock.patch('ocf.logger.info')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('SAPStartSrv.run_command')
+    def test_start_sys5_style_success(self, mock_run_command, mock_logger):
+        self._agent.instance_name = 'ASCS00'
+        self._agent.instance_number = '00'
+        self._agent.saptstartsrv_path = '/mock/sapstartsrv'
+        self._agent.sap_instance_profile = 'my_profile'
+        self._agent.sid = 'PRD'
+        self._agent.sidadm = 'prdadm'
+
+        start_mock = command_result(output='output', err='error', returncode=0)
+        mock_run_command.return_value = start_mock
+
+        self._agent._remove_stale_socket = mock.Mock(return_value=True)
+        self._agent._wait_for_process = mock.Mock(return_value=True)
+        self._agent._wait_for_socket = mock.Mock(return_value=True)
+
+        ocf_returncode = self._agent._start_sys5_style(100)
+        assert ocf_returncode == 0
+
+        self._agent._remove_stale_socket.assert_has_calls([
+            mock.call('/tmp/.sapstream50013'),
+            mock.call('/tmp/.sapstream50014')
+        ])
+        mock_run_command.assert_called_once_with(
+            '/mock/sapstartsrv pf=my_profile -D -u prdadm', mock.ANY, mock.ANY)
+
+        mock_logger.assert_called_once_with(
+            'sapstartsrv for SAP Instance PRD_ASCS00 started: output')
+
+    @mock.patch('ocf.logger.info')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('SAPStartSrv.run_command')
+    def test_start_sys5_style_already_running(self, mock_run_command, mock_logger):
+        self._agent.instance_name = 'ASCS00'
+        self._agent.instance_number = '00'
+        self._agent.sid = 'PRD'
+        self._agent._remove_stale_socket = mock.Mock(side_effect=[False, True])
+        self._agent._get_status = mock.Mock(return_value=0)
+
+        assert self._agent._start_sys5_style(100) == 0
 
+        # Both sockets are checked, no second sapstartsrv is started
+        assert self._agent._remove_stale_socket.call_count == 2
+        assert mock_run_command.call_count == 0
         mock_logger.assert_called_once_with(
-            'InstanceName parsing error. It must follow SID_NAME00_VIRTHOST syntax')
+            'sapstartsrv for SAP Instance PRD_ASCS00 is already running')
 
-        mock_logger.reset_mock()
-        self._agent = SAPStartSrv.SapStartSrv('PRD_ASCS_')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('SAPStartSrv.run_command')
+    def test_start_sys5_style_socket_in_use_not_running(self, mock_run_command):
+        self._agent.instance_name = 'ASCS00'
+        self._agent.instance_number = '00'
+        self._agent.saptstartsrv_path = '/mock/sapstartsrv'
+        self._agent.sap_instance_profile = 'my_profile'
+        self._agent.sid = 'PRD'
+        self._agent.sidadm = 'prdadm'
+        mock_run_command.return_value = command_result(output='output', err='', returncode=0)
+        self._agent._remove_stale_socket = mock.Mock(return_value=False)
+        self._agent._get_status = mock.Mock(return_value=1)
+        self._agent._wait_for_process = mock.Mock(return_value=True)
+        self._agent._wait_for_socket = mock.Mock(return_value=True)
 
-        ocf_returncode = self._agent._inititialize()
-        assert ocf_returncode == 1
+        assert self._agent._start_sys5_style(100) == 0
 
-        mock_logger.assert_called_once_with(
-            'InstanceName parsing error. It must follow SID_NAME00_VIRTHOST syntax')
+        mock_run_command.assert_called_once_with(
+            '/mock/sapstartsrv pf=my_profile -D -u prdadm', 100, None)
 
-    @mock.patch('ocf.logger.info')
-    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_NOT_RUNNING', 1)
     @mock.patch('SAPStartSrv.run_command')
-    def test_start_sys5_style_success(self, mock_run_command, mock_logger):
+    def test_start_sys5_style_error(self, mock_run_command, mock_logger):
         self._agent.instance_name = 'ASCS00'
         self._agent.instance_number = '00'
         self._agent.saptstartsrv_path = '/mock/sapstartsrv'
@@ -544,28 +2074,27 @@ class TestSAPStartSrv(unittest.TestCase):
         self._agent.sid = 'PRD'
         self._agent.sidadm = 'prdadm'
 
-        start_mock = mock.Mock(output='output', err='error')
-        mock_run_command.side_effect = [None, None, start_mock]
+        start_sys5_style_mock = command_result(output='output', err='error', returncode=0)
+        mock_run_command.return_value = start_sys5_style_mock
 
-        get_status_mock = mock.Mock(return_value=0)
-        self._agent._get_status = get_status_mock
+        self._agent._remove_stale_socket = mock.Mock(return_value=True)
+        self._agent._wait_for_process = mock.Mock(return_value=False)
+        self._agent._wait_for_socket = mock.Mock()
 
-        ocf_returncode = self._agent._start_sys5_style()
-        assert ocf_returncode == 0
+        ocf_returncode = self._agent._start_sys5_style(100)
+        assert ocf_returncode == 1
 
-        mock_run_command.assert_has_calls([
-            mock.call('rm -f /tmp/.sapstream50013'),
-            mock.call('rm -f /tmp/.sapstream50014'),
-            mock.call('/mock/sapstartsrv pf=my_profile -D -u prdadm')
-        ])
+        mock_run_command.assert_called_once_with(
+            '/mock/sapstartsrv pf=my_profile -D -u prdadm', mock.ANY, mock.ANY)
 
         mock_logger.assert_called_once_with(
-            'sapstartsrv for SAP Instance PRD_ASCS00 started: output')
+            'sapstartsrv for SAP Instance PRD_ASCS00 start failed: error')
+        assert self._agent._wait_for_socket.call_count == 0
 
     @mock.patch('ocf.logger.error')
     @mock.patch('ocf.OCF_NOT_RUNNING', 1)
     @mock.patch('SAPStartSrv.run_command')
-    def test_start_sys5_style_error(self, mock_run_command, mock_logger):
+    def test_start_sys5_style_command_error(self, mock_run_command, mock_logger):
         self._agent.instance_name = 'ASCS00'
         self._agent.instance_number = '00'
         self._agent.saptstartsrv_path = '/mock/sapstartsrv'
@@ -573,24 +2102,36 @@ class TestSAPStartSrv(unittest.TestCase):
         self._agent.sid = 'PRD'
         self._agent.sidadm = 'prdadm'
 
-        start_sys5_style_mock = mock.Mock(output='output', err='error')
-        mock_run_command.side_effect = [None, None, start_sys5_style_mock]
-
-        get_status_mock = mock.Mock(return_value=1)
-        self._agent._get_status = get_status_mock
+        start_mock = command_result(output='output', err='error', returncode=1)
+        mock_run_command.return_value = start_mock
+        self._agent._remove_stale_socket = mock.Mock(return_value=True)
+        self._agent._wait_for_process = mock.Mock()
 
-        ocf_returncode = self._agent._start_sys5_style()
+        ocf_returncode = self._agent._start_sys5_style(100)
         assert ocf_returncode == 1
 
-        mock_run_command.assert_has_calls([
-            mock.call('rm -f /tmp/.sapstream50013'),
-            mock.call('rm -f /tmp/.sapstream50014'),
-            mock.call('/mock/sapstartsrv pf=my_profile -D -u prdadm')
-        ])
-
+        assert self._agent._wait_for_process.call_count == 0
         mock_logger.assert_called_once_with(
             'sapstartsrv for SAP Instance PRD_ASCS00 start failed: error')
 
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    @mock.patch('SAPStartSrv.run_command')
+    def test_start_sys5_style_command_timeout(self, mock_run_command, mock_logger):
+        self._agent.instance_name = 'ASCS00'
+        self._agent.instance_number = '00'
+        self._agent.sid = 'PRD'
+        mock_run_command.return_value = command_result(returncode=124, timed_out=True)
+        self._agent._remove_stale_socket = mock.Mock(return_value=True)
+        self._agent._wait_for_process = mock.Mock()
+
+        assert self._agent._start_sys5_style(100) == 1
+
+        assert self._agent._wait_for_process.call_count == 0
+        mock_logger.assert_called_once_with(
+            'sapstartsrv for SAP Instance PRD_ASCS00 start timed out, killed at the action '
+            'deadline')
+
     @mock.patch('ocf.logger.info')
     @mock.patch('ocf.OCF_SUCCESS', 0)
     def test_start_systemd_style_success_running(self, mock_logger):
@@ -598,7 +2139,9 @@ class TestSAPStartSrv(unittest.TestCase):
         is_unit_active_mock = mock.Mock(return_value=True)
         self._agent._is_unit_active = is_unit_active_mock
 
-        result = self._agent._start_systemd_style()
+        self._agent._wait_for_socket = mock.Mock(return_value=True)
+
+        result = self._agent._start_systemd_style(100)
         assert result == 0
 
         mock_logger.assert_called_once_with(
@@ -611,19 +2154,78 @@ class TestSAPStartSrv(unittest.TestCase):
         self._agent.systemd_unit_name = 'SAPPRD_00.service'
         is_unit_active_mock = mock.Mock(return_value=False)
         self._agent._is_unit_active = is_unit_active_mock
+        self._agent._unmask_runtime_unit = mock.Mock()
 
-        start_mock = mock.Mock(output='output', err='error', returncode=0)
+        start_mock = command_result(output='output', err='error', returncode=0)
         mock_run_command.return_value = start_mock
 
-        result = self._agent._start_systemd_style()
+        self._agent._wait_for_socket = mock.Mock(return_value=True)
+
+        result = self._agent._start_systemd_style(100)
         assert result == 0
 
+        self._agent._unmask_runtime_unit.assert_called_once_with(mock.ANY)
         mock_run_command.assert_called_once_with(
-            '/usr/bin/systemctl start SAPPRD_00.service')
+            '/usr/bin/systemctl start SAPPRD_00.service', mock.ANY)
 
         mock_logger.assert_called_once_with(
             'systemd service SAPPRD_00.service is not active, it will be started using systemd')
 
+    @mock.patch('SAPStartSrv.run_command')
+    def test_unmask_runtime_unit_not_masked(self, mock_run_command):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent.unit_properties = {'LoadState': 'loaded'}
+
+        self._agent._unmask_runtime_unit(100)
+
+        mock_run_command.assert_not_called()
+
+    @mock.patch('ocf.logger.info')
+    @mock.patch('os.path.realpath')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_unmask_runtime_unit(self, mock_run_command, mock_realpath, mock_logger):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent.unit_properties = {'LoadState': 'masked'}
+        mock_realpath.return_value = os.devnull
+        mock_run_command.return_value = command_result(returncode=0)
+
+        self._agent._unmask_runtime_unit(100)
+
+        mock_realpath.assert_called_once_with('/run/systemd/system/SAPPRD_00.service')
+        mock_run_command.assert_called_once_with(
+            '/usr/bin/systemctl --runtime unmask SAPPRD_00.service', 100)
+        assert self._agent.unit_properties is None
+        mock_logger.assert_called_once_with(
+            'runtime mask of systemd unit SAPPRD_00.service removed')
+
+    @mock.patch('ocf.logger.error')
+    @mock.patch('os.path.realpath')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_unmask_runtime_unit_error(self, mock_run_command, mock_realpath, mock_logger):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent.unit_properties = {'LoadState': 'masked'}
+        mock_realpath.return_value = os.devnull
+        mock_run_command.return_value = command_result(returncode=1, output='denied')
+
+        self._agent._unmask_runtime_unit(100)
+
+        mock_logger.assert_called_once_with(
+            'error during unmask of systemd unit SAPPRD_00.service: denied')
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('os.path.realpath')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_unmask_runtime_unit_persistent(self, mock_run_command, mock_realpath, mock_logger):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent.unit_properties = {'LoadState': 'masked'}
+        mock_realpath.return_value = '/run/systemd/system/SAPPRD_00.service'
+
+        self._agent._unmask_runtime_unit(100)
+
+        mock_run_command.assert_not_called()
+        mock_logger.assert_called_once_with(
+            'systemd unit SAPPRD_00.service is masked persistently')
+
     @mock.patch('ocf.logger.error')
     @mock.patch('ocf.OCF_SUCCESS', 0)
     @mock.patch('ocf.OCF_NOT_RUNNING', 7)
@@ -633,16 +2235,17 @@ class TestSAPStartSrv(unittest.TestCase):
         self._agent.systemd_unit_name = 'SAPPRD_00.service'
         is_unit_active_mock = mock.Mock(return_value=False)
         self._agent._is_unit_active = is_unit_active_mock
+        self._agent._unmask_runtime_unit = mock.Mock()
 
-        start_mock = mock.Mock(output='output', err='error', returncode=1)
+        start_mock = command_result(output='output', err='error', returncode=1)
         mock_run_command.return_value = start_mock
         mock_is_probe.return_value = True
 
-        result = self._agent._start_systemd_style()
+        result = self._agent._start_systemd_style(100)
         assert result == 7
 
         mock_run_command.assert_called_once_with(
-            '/usr/bin/systemctl start SAPPRD_00.service')
+            '/usr/bin/systemctl start SAPPRD_00.service', mock.ANY)
 
         mock_logger.assert_called_once_with(
             'error during start of systemd unit SAPPRD_00.service!')
@@ -657,23 +2260,62 @@ class TestSAPStartSrv(unittest.TestCase):
         self._agent.systemd_unit_name = 'SAPPRD_00.service'
         is_unit_active_mock = mock.Mock(return_value=False)
         self._agent._is_unit_active = is_unit_active_mock
+        self._agent._unmask_runtime_unit = mock.Mock()
 
-        start_mock = mock.Mock(output='output', err='error', returncode=1)
+        start_mock = command_result(output='output', err='error', returncode=1)
         mock_run_command.return_value = start_mock
         mock_is_probe.return_value = False
 
-        result = self._agent._start_systemd_style()
+        result = self._agent._start_systemd_style(100)
         assert result == 1
 
         mock_run_command.assert_called_once_with(
-            '/usr/bin/systemctl start SAPPRD_00.service')
+            '/usr/bin/systemctl start SAPPRD_00.service', mock.ANY)
 
         mock_logger.assert_called_once_with(
             'error during start of systemd unit SAPPRD_00.service!')
 
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    @mock.patch('ocf.is_probe')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_start_systemd_style_timeout(self, mock_run_command, mock_is_probe, mock_logger):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent._is_unit_active = mock.Mock(return_value=False)
+        self._agent._unmask_runtime_unit = mock.Mock()
+        self._agent._wait_for_socket = mock.Mock()
+        mock_run_command.return_value = command_result(returncode=124, timed_out=True)
+        mock_is_probe.return_value = True
+
+        # Even a probe reports the error, the unit state is unknown
+        assert self._agent._start_systemd_style(100) == 1
+
+        assert self._agent._wait_for_socket.call_count == 0
+        mock_logger.assert_called_once_with(
+            'start of systemd unit SAPPRD_00.service timed out, killed at the action deadline!')
+
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    def test_start_systemd_style_not_ready(self, mock_logger):
+        self._agent.systemd_unit_name = 'SAPPRD_00.service'
+        self._agent.instance_number = '00'
+        self._agent._is_unit_active = mock.Mock(return_value=True)
+        self._agent._wait_for_socket = mock.Mock(return_value=False)
+
+        result = self._agent._start_systemd_style(100)
+        assert result == 1
+
+        self._agent._wait_for_socket.assert_called_once_with(100)
+        mock_logger.assert_called_once_with(
+            'sapstartsrv of systemd unit SAPPRD_00.service does not accept connections in '
+            '/tmp/.sapstream50013!')
+
     @mock.patch('ocf.OCF_SUCCESS', 0)
-    def test_start_systemd_style_success(self):
-        self._agent._inititialize = mock.Mock()
+    @mock.patch('SAPStartSrv.get_action_deadline')
+    def test_start_systemd_style_success(self, mock_get_action_deadline):
+        mock_get_action_deadline.return_value = 100
+        self._agent._parse_instance_name = mock.Mock()
+        self._agent._prepare_environment = mock.Mock(return_value=0)
 
         chk_systemd_support_mock = mock.Mock(return_value=True)
         self._agent._chk_systemd_support = chk_systemd_support_mock
@@ -683,25 +2325,57 @@ class TestSAPStartSrv(unittest.TestCase):
         result = self._agent.start()
         assert result == 0
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
+        self._agent._prepare_environment.assert_called_once_with()
+        # One deadline for the whole start, computed when it begins
+        mock_get_action_deadline.assert_called_once_with()
+        start_systemd_style_mock.assert_called_once_with(100)
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
     def test_start_success_sys5_style(self):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock()
+        self._agent._prepare_environment = mock.Mock(return_value=0)
 
         chk_systemd_support_mock = mock.Mock(return_value=False)
         self._agent._chk_systemd_support = chk_systemd_support_mock
         start_sys5_style_mock = mock.Mock(return_value=0)
         self._agent._start_sys5_style = start_sys5_style_mock
+        SAPStartSrv.write_state('PRD_ASCS00_virthost.pid', {'pid': 1234})
+        SAPStartSrv.write_state('PRD_ASCS00_virthost.services', {'summary': '', 'time': 0})
 
         result = self._agent.start()
         assert result == 0
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.services') is None
+
+        self._agent._parse_instance_name.assert_called_once_with()
+        self._agent._prepare_environment.assert_called_once_with()
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    def test_start_sys5_style_preparation(self):
+        self._agent._parse_instance_name = mock.Mock()
+        self._agent._chk_systemd_support = mock.Mock(return_value=False)
+        barrier = threading.Barrier(2, timeout=5)
+
+        def prepare_environment():
+            # The environment is prepared while the systemd support is checked
+            barrier.wait()
+            return 0
+
+        def start_sys5_style(deadline, preparation):
+            barrier.wait()
+            assert preparation.result() == 0
+            return 0
+
+        self._agent._prepare_environment = prepare_environment
+        self._agent._start_sys5_style = start_sys5_style
 
-        self._agent._inititialize.assert_called_once_with()
+        assert self._agent.start() == 0
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
     def test_start_error_sys5_style(self):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock()
+        self._agent._prepare_environment = mock.Mock(return_value=0)
 
         chk_systemd_support_mock = mock.Mock(return_value=False)
         self._agent._chk_systemd_support = chk_systemd_support_mock
@@ -711,11 +2385,13 @@ class TestSAPStartSrv(unittest.TestCase):
         result = self._agent.start()
         assert result == 1
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
+        self._agent._prepare_environment.assert_called_once_with()
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
     def test_start_success_systemd_style(self):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock()
+        self._agent._prepare_environment = mock.Mock(return_value=0)
 
         chk_systemd_support_mock = mock.Mock(return_value=True)
         self._agent._chk_systemd_support = chk_systemd_support_mock
@@ -725,11 +2401,13 @@ class TestSAPStartSrv(unittest.TestCase):
         result = self._agent.start()
         assert result == 0
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
+        self._agent._prepare_environment.assert_called_once_with()
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
     def test_start_error_systemd_style(self):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock()
+        self._agent._prepare_environment = mock.Mock(return_value=0)
 
         chk_systemd_support_mock = mock.Mock(return_value=True)
         self._agent._chk_systemd_support = chk_systemd_support_mock
@@ -739,30 +2417,135 @@ class TestSAPStartSrv(unittest.TestCase):
         result = self._agent.start()
         assert result == 1
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
+        self._agent._prepare_environment.assert_called_once_with()
+
+    def test_sapcontrol_client_stop_service(self):
+        socket_path = os.path.join(self._state_dir, 'sapstream')
+        with CannedSapControlServer(socket_path) as server:
+            SAPStartSrv.SapControlClient(socket_path).stop_service()
+
+        assert len(server.requests) == 1
+        assert '<SAPControl:StopService></SAPControl:StopService>' in server.requests[0]
+
+    def test_sapcontrol_client_get_process_list(self):
+        socket_path = os.path.join(self._state_dir, 'sapstream')
+        with CannedSapControlServer(socket_path):
+            processes = SAPStartSrv.SapControlClient(socket_path).get_process_list()
+
+        assert processes == [
+            {'name': 'msg_server', 'description': 'MessageServer',
+             'dispstatus': 'SAPControl-GREEN', 'textstatus': 'Running',
+             'starttime': '2026 10 18 10:00:00', 'elapsedtime': '1:00:00', 'pid': '1234'},
+            {'name': 'enq_server', 'description': 'Enqueue Server 2',
+             'dispstatus': 'SAPControl-GRAY', 'textstatus': 'Stopped',
+             'starttime': '', 'elapsedtime': '', 'pid': '-1'},
+        ]
+
+    def test_sapcontrol_client_parameter_value(self):
+        socket_path = os.path.join(self._state_dir, 'sapstream')
+        with CannedSapControlServer(socket_path) as server:
+            value = SAPStartSrv.SapControlClient(socket_path).parameter_value('SAPSYSTEMNAME')
+
+        assert value == 'PRD'
+        assert '<parameter>SAPSYSTEMNAME</parameter>' in server.requests[0]
+
+    def test_sapcontrol_client_fault(self):
+        socket_path = os.path.join(self._state_dir, 'sapstream')
+        with CannedSapControlServer(socket_path, responses={}):
+            with self.assertRaises(SAPStartSrv.SapControlError) as err:
+                SAPStartSrv.SapControlClient(socket_path).stop_service()
+
+        assert str(err.exception) == 'StopService failed: Permission denied'
+
+    def test_sapcontrol_client_invalid_response(self):
+        socket_path = os.path.join(self._state_dir, 'sapstream')
+        with CannedSapControlServer(socket_path, responses={'StopService': (200, '')}):
+            with self.assertRaises(SAPStartSrv.SapControlError) as err:
+                SAPStartSrv.SapControlClient(socket_path).stop_service()
+
+        assert str(err.exception) == 'StopService returned an invalid response: HTTP 200'
+
+    def test_sapcontrol_client_connection_error(self):
+        socket_path = os.path.join(self._state_dir, 'sapstream')
+        with self.assertRaises(SAPStartSrv.SapControlError):
+            SAPStartSrv.SapControlClient(socket_path, timeout=1).stop_service()
+
+    @mock.patch('ocf.logger.info')
+    def test_stop_service_native(self, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        self._agent.instance_number = '00'
+        client = mock.Mock()
+        self._agent._get_sapcontrol_client = mock.Mock(return_value=client)
+
+        assert self._agent._stop_service_native() is True
+
+        client.stop_service.assert_called_once_with()
+        mock_logger.assert_called_once_with(
+            'Stopping sapstartsrv of SAP Instance PRD_ASCS00: StopService called through '
+            '/tmp/.sapstream50013')
+
+    @mock.patch('ocf.logger.warning')
+    def test_stop_service_native_error(self, mock_logger):
+        self._agent.instance_number = '00'
+        client = mock.Mock()
+        client.stop_service.side_effect = SAPStartSrv.SapControlError('error')
+        self._agent._get_sapcontrol_client = mock.Mock(return_value=client)
+
+        assert self._agent._stop_service_native() is False
+
+        mock_logger.assert_called_once_with(
+            'StopService through /tmp/.sapstream50013 failed, using sapcontrol: error')
+
+    def test_get_sapcontrol_client(self):
+        self._agent.instance_number = '10'
+        client = self._agent._get_sapcontrol_client(timeout=0.5)
+        assert client.socket_path == '/tmp/.sapstream51013'
+        assert client.timeout == 0.5
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('SAPStartSrv.run_command')
+    def test_stop_native(self, mock_run_command):
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
+        self._agent._get_status = mock.Mock(return_value=0)
+        self._agent._stop_service_native = mock.Mock(return_value=True)
+        self._agent._remove_services_attribute = mock.Mock()
+        SAPStartSrv.write_state('PRD_ASCS00_virthost.pid', {'pid': 1234})
+
+        assert self._agent.stop() == 0
+
+        assert mock_run_command.call_count == 0
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
+        self._agent._remove_services_attribute.assert_called_once_with()
 
     @mock.patch('ocf.logger.info')
     @mock.patch('ocf.OCF_SUCCESS', 0)
     @mock.patch('SAPStartSrv.run_command')
     def test_stop_success(self, mock_run_command, mock_logger):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
         self._agent.instance_name = 'ASCS00'
         self._agent.instance_number = '00'
         self._agent.sapcontrol_path = '/mock/sapcontrol'
         self._agent.sid = 'PRD'
 
-        mock_command = mock.Mock(output='output', err='error', returncode=0)
+        mock_command = command_result(output='output', err='error', returncode=0)
         mock_run_command.return_value = mock_command
 
         self._agent._get_status = mock.Mock(return_value=0)
+        SAPStartSrv.write_state('PRD_ASCS00_virthost.pid', {'pid': 1234})
 
+        self._agent._stop_service_native = mock.Mock(return_value=False)
+        self._agent._prepare_environment = mock.Mock(return_value=0)
         ocf_returncode = self._agent.stop()
         assert ocf_returncode == 0
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.pid') is None
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
         self._agent._get_status.assert_called_once_with()
 
-        mock_run_command.assert_called_once_with('/mock/sapcontrol -nr 00 -function StopService')
+        mock_run_command.assert_called_once_with(
+            '/mock/sapcontrol -nr 00 -function StopService', mock.ANY, None)
 
         mock_logger.assert_called_once_with(
             'Stopping sapstartsrv of SAP Instance PRD_ASCS00: output')
@@ -771,16 +2554,17 @@ class TestSAPStartSrv(unittest.TestCase):
     @mock.patch('ocf.OCF_SUCCESS', 0)
     @mock.patch('SAPStartSrv.run_command')
     def test_stop_already_stopped(self, mock_run_command, mock_logger):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
         self._agent.instance_name = 'ASCS00'
         self._agent.sid = 'PRD'
 
         self._agent._get_status = mock.Mock(return_value=1)
+        self._agent._prepare_environment = mock.Mock(return_value=0)
 
         ocf_returncode = self._agent.stop()
         assert ocf_returncode == 0
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
         self._agent._get_status.assert_called_once_with()
 
         assert mock_run_command.call_count == 0
@@ -789,58 +2573,62 @@ class TestSAPStartSrv(unittest.TestCase):
             'SAP Instance PRD_ASCS00 already stopped')
 
     @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
     @mock.patch('ocf.OCF_ERR_GENERIC', 1)
     @mock.patch('SAPStartSrv.run_command')
     def test_stop_error(self, mock_run_command, mock_logger):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
         self._agent.instance_name = 'ASCS00'
         self._agent.instance_number = '00'
         self._agent.sapcontrol_path = '/mock/sapcontrol'
         self._agent.sid = 'PRD'
 
-        mock_command = mock.Mock(output='output', err='error', returncode=1)
+        mock_command = command_result(output='output', err='error', returncode=1)
         mock_run_command.return_value = mock_command
 
         self._agent._get_status = mock.Mock(return_value=0)
 
+        self._agent._stop_service_native = mock.Mock(return_value=False)
+        self._agent._prepare_environment = mock.Mock(return_value=0)
         ocf_returncode = self._agent.stop()
         assert ocf_returncode == 1
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
         self._agent._get_status.assert_called_once_with()
 
-        mock_run_command.assert_called_once_with('/mock/sapcontrol -nr 00 -function StopService')
+        mock_run_command.assert_called_once_with(
+            '/mock/sapcontrol -nr 00 -function StopService', mock.ANY, None)
 
         mock_logger.assert_called_once_with(
             'SAP Instance PRD_ASCS00 stop failed: error')
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
     def test_status_success(self):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
         get_status_mock = mock.Mock(return_value=0)
         self._agent._get_status = get_status_mock
 
         ocf_returncode = self._agent.status()
         assert ocf_returncode == 0
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
         self._agent._get_status.assert_called_once_with()
 
     @mock.patch('ocf.OCF_NOT_RUNNING', 1)
     def test_status_error(self):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
         self._agent._get_status = mock.Mock(return_value=mock.Mock(returncode=1))
 
         ocf_returncode = self._agent.status()
         assert ocf_returncode == 1
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
         self._agent._get_status.assert_called_once_with()
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
     @mock.patch('ocf.is_probe')
     def test_monitor_success(self, mock_is_probe):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
         get_status_mock = mock.Mock(return_value=0)
         self._agent._get_status = get_status_mock
         mock_is_probe.return_value = True
@@ -848,25 +2636,261 @@ class TestSAPStartSrv(unittest.TestCase):
         ocf_returncode = self._agent.monitor()
         assert ocf_returncode == 0
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
         self._agent._get_status.assert_called_once_with()
 
     @mock.patch('ocf.OCF_SUCCESS', 0)
     @mock.patch('ocf.is_probe')
     def test_monitor_error(self, mock_is_probe):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock()
         self._agent._get_status = mock.Mock()
         mock_is_probe.return_value = False
 
         ocf_returncode = self._agent.monitor()
         assert ocf_returncode == 0
 
-        self._agent._inititialize.assert_called_once_with()
+        assert self._agent._parse_instance_name.call_count == 0
         assert self._agent._get_status.call_count == 0
 
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.is_probe')
+    def test_monitor_liveness(self, mock_is_probe):
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
+        self._agent._check_liveness = mock.Mock(return_value=1)
+        mock_is_probe.return_value = False
+
+        with mock.patch.dict(os.environ, {'OCF_CHECK_LEVEL': '10'}):
+            ocf_returncode = self._agent.monitor()
+        assert ocf_returncode == 1
+
+        self._agent._check_liveness.assert_called_once_with()
+
+        with mock.patch.dict(os.environ, {'OCF_CHECK_LEVEL': '0'}):
+            ocf_returncode = self._agent.monitor()
+        assert ocf_returncode == 0
+        assert self._agent._check_liveness.call_count == 1
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.is_probe')
+    def test_monitor_services(self, mock_is_probe):
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
+        self._agent._check_services = mock.Mock(return_value=0)
+        self._agent._check_liveness = mock.Mock()
+        mock_is_probe.return_value = False
+
+        with mock.patch.dict(os.environ, {'OCF_RESKEY_OCF_CHECK_LEVEL': '20'}):
+            os.environ.pop('OCF_CHECK_LEVEL', None)
+            ocf_returncode = self._agent.monitor()
+        assert ocf_returncode == 0
+
+        self._agent._check_services.assert_called_once_with()
+        assert self._agent._check_liveness.call_count == 0
+
+    def test_compile_monitor_services(self):
+        regex = SAPStartSrv.compile_monitor_services(SAPStartSrv.MONITOR_SERVICES_DEFAULT)
+        assert regex.match('disp+work')
+        assert regex.match('enq_server')
+        assert not regex.match('dispwork')
+        assert not regex.match('enq_server2')
+        assert not regex.match('gwrd')
+
+    @mock.patch('ocf.logger.debug')
+    @mock.patch('ocf.get_parameter')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    def test_check_services(self, mock_get_parameter, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        mock_get_parameter.return_value = 'msg_server|enq_server'
+        client = mock.Mock()
+        client.get_process_list.return_value = [
+            {'name': 'msg_server', 'dispstatus': 'SAPControl-GREEN'},
+            {'name': 'gwrd', 'dispstatus': 'SAPControl-GREEN'},
+            {'name': 'enq_server', 'dispstatus': 'SAPControl-GRAY'}
+        ]
+        self._agent._get_sapcontrol_client = mock.Mock(return_value=client)
+        self._agent._update_services_attribute = mock.Mock()
+
+        assert self._agent._check_services() == 0
+
+        mock_get_parameter.assert_called_once_with(
+            'MONITOR_SERVICES', SAPStartSrv.MONITOR_SERVICES_DEFAULT)
+        self._agent._update_services_attribute.assert_called_once_with(
+            'msg_server:GREEN,enq_server:GRAY')
+        mock_logger.assert_called_once_with(
+            'SAP Instance PRD_ASCS00 services: msg_server:GREEN,enq_server:GRAY')
+
+    def test_check_services_error(self):
+        client = mock.Mock()
+        err = SAPStartSrv.SapControlError('error')
+        client.get_process_list.side_effect = err
+        self._agent._get_sapcontrol_client = mock.Mock(return_value=client)
+        self._agent._report_unresponsive = mock.Mock(return_value=1)
+
+        assert self._agent._check_services() == 1
+        self._agent._report_unresponsive.assert_called_once_with(err)
+
+    @mock.patch('time.time')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_update_services_attribute(self, mock_run_command, mock_time):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        mock_run_command.return_value = command_result(returncode=0)
+        mock_time.return_value = 1000
+
+        self._agent._update_services_attribute('msg_server:GREEN')
+        mock_run_command.assert_called_once_with(
+            '/usr/sbin/attrd_updater -n sapstartsrv_PRD_ASCS00_services -U "msg_server:GREEN"')
+
+        # Unchanged summary, only checked that the attribute still exists
+        mock_time.return_value = 1100
+        mock_run_command.reset_mock()
+        self._agent._update_services_attribute('msg_server:GREEN')
+        mock_run_command.assert_called_once_with(
+            '/usr/sbin/attrd_updater -n sapstartsrv_PRD_ASCS00_services -Q')
+
+        mock_run_command.reset_mock()
+        self._agent._update_services_attribute('msg_server:RED')
+        mock_run_command.assert_called_once_with(
+            '/usr/sbin/attrd_updater -n sapstartsrv_PRD_ASCS00_services -U "msg_server:RED"')
+
+        mock_time.return_value = 1800
+        mock_run_command.reset_mock()
+        self._agent._update_services_attribute('msg_server:RED')
+        mock_run_command.assert_called_once_with(
+            '/usr/sbin/attrd_updater -n sapstartsrv_PRD_ASCS00_services -U "msg_server:RED"')
+
+    @mock.patch('time.time')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_update_services_attribute_lost(self, mock_run_command, mock_time):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        mock_time.return_value = 1000
+        SAPStartSrv.write_state(
+            'PRD_ASCS00_virthost.services', {'summary': 'msg_server:GREEN', 'time': 900})
+
+        # pacemaker was restarted and the transient attribute is gone
+        mock_run_command.side_effect = [command_result(returncode=105), command_result(returncode=0)]
+        self._agent._update_services_attribute('msg_server:GREEN')
+
+        mock_run_command.assert_has_calls([
+            mock.call('/usr/sbin/attrd_updater -n sapstartsrv_PRD_ASCS00_services -Q'),
+            mock.call(
+                '/usr/sbin/attrd_updater -n sapstartsrv_PRD_ASCS00_services '
+                '-U "msg_server:GREEN"')])
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.services')['time'] == 1000
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_remove_services_attribute(self, mock_run_command, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+
+        # Not published on this node
+        self._agent._remove_services_attribute()
+        assert mock_run_command.call_count == 0
+
+        SAPStartSrv.write_state(
+            'PRD_ASCS00_virthost.services', {'summary': 'msg_server:GREEN', 'time': 900})
+        mock_run_command.return_value = command_result(returncode=0)
+        self._agent._remove_services_attribute()
+
+        mock_run_command.assert_called_once_with(
+            '/usr/sbin/attrd_updater -n sapstartsrv_PRD_ASCS00_services -D')
+        assert SAPStartSrv.read_state('PRD_ASCS00_virthost.services') is None
+        assert mock_logger.call_count == 0
+
+        SAPStartSrv.write_state(
+            'PRD_ASCS00_virthost.services', {'summary': 'msg_server:GREEN', 'time': 900})
+        mock_run_command.return_value = command_result(returncode=1, err='error')
+        self._agent._remove_services_attribute()
+        mock_logger.assert_called_once_with(
+            'Cannot delete node attribute sapstartsrv_PRD_ASCS00_services: error')
+
+    @mock.patch('ocf.logger.warning')
+    @mock.patch('SAPStartSrv.run_command')
+    def test_update_services_attribute_error(self, mock_run_command, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        mock_run_command.return_value = command_result(returncode=1, err='error')
+
+        self._agent._update_services_attribute('msg_server:GREEN')
+        self._agent._update_services_attribute('msg_server:GREEN')
+
+        assert mock_run_command.call_count == 2
+        mock_logger.assert_called_with(
+            'Cannot update node attribute sapstartsrv_PRD_ASCS00_services: error')
+
+        mock_run_command.return_value = command_result(returncode=124, timed_out=True)
+        self._agent._update_services_attribute('msg_server:GREEN')
+        mock_logger.assert_called_with(
+            'Cannot update node attribute sapstartsrv_PRD_ASCS00_services: '
+            'timed out, killed at the action deadline')
+
+    def test_get_check_level(self):
+        with mock.patch.dict(os.environ, {'OCF_CHECK_LEVEL': '10'}):
+            assert SAPStartSrv.get_check_level() == 10
+
+        with mock.patch.dict(os.environ, {'OCF_CHECK_LEVEL': 'invalid'}):
+            assert SAPStartSrv.get_check_level() == 0
+
+        with mock.patch.dict(os.environ, {}):
+            os.environ.pop('OCF_CHECK_LEVEL', None)
+            os.environ.pop('OCF_RESKEY_OCF_CHECK_LEVEL', None)
+            assert SAPStartSrv.get_check_level() == 0
+
+            # pacemaker passes the check level of the monitor operation as instance parameter
+            os.environ['OCF_RESKEY_OCF_CHECK_LEVEL'] = '20'
+            assert SAPStartSrv.get_check_level() == 20
+
+            os.environ['OCF_CHECK_LEVEL'] = '10'
+            assert SAPStartSrv.get_check_level() == 20
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    def test_check_liveness(self):
+        client = mock.Mock()
+        self._agent._get_sapcontrol_client = mock.Mock(return_value=client)
+
+        assert self._agent._check_liveness() == 0
+
+        self._agent._get_sapcontrol_client.assert_called_once_with(0.8)
+        client.parameter_value.assert_called_once_with('SAPSYSTEMNAME')
+
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    @mock.patch('ocf.OCF_NOT_RUNNING', 7)
+    def test_check_liveness_error(self, mock_logger):
+        self._agent.sid = 'PRD'
+        self._agent.instance_name = 'ASCS00'
+        client = mock.Mock()
+        client.parameter_value.side_effect = SAPStartSrv.SapControlError('timed out')
+        self._agent._get_sapcontrol_client = mock.Mock(return_value=client)
+
+        self._agent._get_status = mock.Mock(return_value=0)
+        assert self._agent._check_liveness() == 1
+        mock_logger.assert_called_once_with(
+            'sapstartsrv of SAP Instance PRD_ASCS00 does not respond: timed out')
+
+        self._agent._get_status = mock.Mock(return_value=1)
+        assert self._agent._check_liveness() == 7
+
+    def test_check_liveness_hung_server(self):
+        socket_path = os.path.join(self._state_dir, 'sapstream')
+        self._agent._get_socket_path = mock.Mock(return_value=socket_path)
+        self._agent._get_status = mock.Mock(return_value=0)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+        try:
+            start = time.monotonic()
+            with mock.patch('ocf.OCF_ERR_GENERIC', 1), mock.patch('ocf.logger.error'):
+                assert self._agent._check_liveness() == 1
+            assert time.monotonic() - start < 1
+        finally:
+            server.close()
+
     @mock.patch('ocf.OCF_SUCCESS', 0)
     def test_validate(self):
-        self._agent._inititialize = mock.Mock()
+        self._agent._parse_instance_name = mock.Mock(return_value=0)
         self._agent.sid = 'PRD'
         self._agent.instance_number = '00'
         self._agent.instance_name = 'ASCS00'
@@ -875,7 +2899,7 @@ class TestSAPStartSrv(unittest.TestCase):
         ocf_returncode = self._agent.validate()
         assert ocf_returncode == 0
 
-        self._agent._inititialize.assert_called_once_with()
+        self._agent._parse_instance_name.assert_called_once_with()
 
         self._agent.sid = 'H1A'
         self._agent.instance_number = '99'
@@ -896,7 +2920,6 @@ class TestSAPStartSrv(unittest.TestCase):
     @mock.patch('ocf.logger.error')
     @mock.patch('ocf.OCF_ERR_ARGS', 1)
     def test_validate_invalid_sid(self, mock_logger):
-        self._agent._inititialize = mock.Mock()
         self._agent.sid = 'PRDD'
 
         ocf_returncode = self._agent.validate()
@@ -926,7 +2949,6 @@ class TestSAPStartSrv(unittest.TestCase):
     @mock.patch('ocf.logger.error')
     @mock.patch('ocf.OCF_ERR_ARGS', 1)
     def test_validate_invalid_instance_name(self, mock_logger):
-        self._agent._inititialize = mock.Mock()
         self._agent.sid = 'PRD'
         self._agent.instance_name = 'ASCS'
 
@@ -970,7 +2992,6 @@ class TestSAPStartSrv(unittest.TestCase):
     @mock.patch('ocf.logger.error')
     @mock.patch('ocf.OCF_ERR_ARGS', 1)
     def test_validate_invalid_instance_number(self, mock_logger):
-        self._agent._inititialize = mock.Mock()
         self._agent.sid = 'PRD'
         self._agent.instance_name = 'ASCS00'
         self._agent.instance_number = '0'
@@ -1015,7 +3036,6 @@ class TestSAPStartSrv(unittest.TestCase):
     @mock.patch('ocf.logger.error')
     @mock.patch('ocf.OCF_ERR_ARGS', 1)
     def test_validate_invalid_virthost(self, mock_logger):
-        self._agent._inititialize = mock.Mock()
         self._agent.sid = 'PRD'
         self._agent.instance_name = 'ASCS00'
         self._agent.instance_number = '00'
@@ -1058,17 +3078,166 @@ class TestSAPStartSrv(unittest.TestCase):
             'Parsing instance profile name: %s is not a valid virtual host name!' %
             self._agent.virtual_host)
 
+    def test_create_agent_instance(self):
+        agent = SAPStartSrv.create_agent_instance('PRD_ASCS00_virthost')
+        assert isinstance(agent, SAPStartSrv.SapStartSrv)
+        assert agent.full_name == 'PRD_ASCS00_virthost'
+
+        agent = SAPStartSrv.create_agent_instance('PRD_ASCS00_virthost, PRD_ERS10_virthost2,')
+        assert isinstance(agent, SAPStartSrv.MultiSapStartSrv)
+        assert [instance.full_name for instance in agent.instances] == [
+            'PRD_ASCS00_virthost', 'PRD_ERS10_virthost2']
+
+    @mock.patch('SAPStartSrv.query_unit_properties')
+    @mock.patch('SAPStartSrv.build_process_index')
+    @mock.patch('ocf.have_binary')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    def test_multi_prepare_instances(
+            self, mock_have_binary, mock_build_process_index, mock_query_unit_properties):
+        multi = SAPStartSrv.MultiSapStartSrv(
+            ['PRD_ASCS00_virthost', 'PRD_ERS10_virthost2', 'invalid'])
+        mock_have_binary.return_value = True
+        mock_build_process_index.return_value = {'index': 1}
+        mock_query_unit_properties.return_value = {
+            'SAPPRD_00.service': {'ActiveState': 'active'},
+            'SAPPRD_10.service': {'ActiveState': 'inactive'}}
+
+        multi._prepare_instances()
+
+        mock_build_process_index.assert_called_once_with()
+        mock_query_unit_properties.assert_called_once_with(
+            ['SAPPRD_00.service', 'SAPPRD_10.service'])
+        assert [instance.process_index for instance in multi.instances] == [
+            {'index': 1}, {'index': 1}, None]
+        assert [instance.unit_properties for instance in multi.instances] == [
+            {'ActiveState': 'active'}, {'ActiveState': 'inactive'}, None]
+
+        mock_query_unit_properties.return_value = None
+        multi._prepare_instances()
+        assert [instance.unit_properties for instance in multi.instances] == [{}, {}, None]
+
+    @mock.patch('SAPStartSrv.build_process_index')
+    def test_multi_prepare_instances_invalid(self, mock_build_process_index):
+        multi = SAPStartSrv.MultiSapStartSrv(['invalid', 'invalid2'])
+        multi._prepare_instances()
+        mock_build_process_index.assert_not_called()
+
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    @mock.patch('ocf.OCF_NOT_RUNNING', 7)
+    def test_multi_merge_results(self):
+        merge = SAPStartSrv.MultiSapStartSrv._merge_results
+        assert merge([0, 0]) == 0
+        assert merge([7, 7]) == 7
+        assert merge([0, 7]) == 1
+        assert merge([0, 5, 2]) == 5
+
+    @mock.patch('ocf.get_parameter')
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.logger.info')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.OCF_ERR_GENERIC', 1)
+    @mock.patch('ocf.OCF_NOT_RUNNING', 7)
+    def test_multi_run(self, mock_info, mock_error, mock_get_parameter):
+        mock_get_parameter.return_value = None
+        multi = SAPStartSrv.MultiSapStartSrv(['PRD_ASCS00_virthost', 'PRD_ERS10_virthost2'])
+        multi._prepare_instances = mock.Mock()
+        barrier = threading.Barrier(2, timeout=5)
+
+        def start():
+            # Both instances must be started at the same time
+            barrier.wait()
+            return 0
+
+        multi.instances[0].start = start
+        multi.instances[1].start = start
+        assert multi.start() == 0
+        multi._prepare_instances.assert_called_once_with()
+        mock_info.assert_has_calls([
+            mock.call('start of PRD_ASCS00_virthost: 0'),
+            mock.call('start of PRD_ERS10_virthost2: 0')])
+
+        multi.instances[0].stop = mock.Mock(return_value=0)
+        multi.instances[1].stop = mock.Mock(side_effect=ValueError('error'))
+        assert multi.stop() == 1
+        mock_error.assert_called_once_with('stop of PRD_ERS10_virthost2 failed: error')
+
+        multi.instances[0].status = mock.Mock(return_value=7)
+        multi.instances[1].status = mock.Mock(return_value=7)
+        assert multi.status() == 7
+
+        multi._prepare_instances.reset_mock()
+        SAPStartSrv.TIMER.enabled = True
+        SAPStartSrv.TIMER.report = mock.Mock()
+        multi.instances[0].validate = mock.Mock(return_value=0)
+        multi.instances[1].validate = mock.Mock(return_value=2)
+        assert multi.validate() == 2
+        multi._prepare_instances.assert_not_called()
+        SAPStartSrv.TIMER.report.assert_called_once_with(
+            'PRD_ASCS00_virthost,PRD_ERS10_virthost2', 'validate', 2, mock.ANY)
+
+    @mock.patch('ocf.get_parameter')
+    @mock.patch('ocf.logger.error')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    @mock.patch('ocf.OCF_ERR_CONFIGURED', 6)
+    def test_multi_single_instance_parameters(self, mock_error, mock_get_parameter):
+        multi = SAPStartSrv.MultiSapStartSrv(['PRD_ASCS00_virthost', 'PRD_ERS10_virthost2'])
+        multi._run = mock.Mock(return_value=0)
+        parameters = {'DIR_EXECUTABLE': '/usr/sap/PRD/ASCS00/exe', 'DIR_PROFILE': ''}
+        mock_get_parameter.side_effect = lambda name, default=None: parameters.get(name, default)
+
+        assert multi.validate() == 6
+        assert multi.start() == 6
+        multi._run.assert_not_called()
+        mock_error.assert_called_with(
+            'DIR_EXECUTABLE cannot be used with several instances in InstanceName')
+
+        parameters = {'DIR_PROFILE': '/profile', 'SAP_INSTANCE_PROFILE': '/profile/PRD'}
+        assert multi.validate() == 6
+        mock_error.assert_called_with(
+            'DIR_PROFILE, SAP_INSTANCE_PROFILE cannot be used with several instances in '
+            'InstanceName')
+
+        parameters = {}
+        assert multi.validate() == 0
+        assert multi.start() == 0
+        multi._run.assert_has_calls([mock.call('validate', False), mock.call('start')])
+
+    @mock.patch('SAPStartSrv.get_check_level')
+    @mock.patch('ocf.is_probe')
+    @mock.patch('ocf.OCF_SUCCESS', 0)
+    def test_multi_monitor(self, mock_is_probe, mock_get_check_level):
+        multi = SAPStartSrv.MultiSapStartSrv(['PRD_ASCS00_virthost', 'PRD_ERS10_virthost2'])
+        multi._run = mock.Mock(return_value=7)
+
+        mock_is_probe.return_value = False
+        mock_get_check_level.return_value = 0
+        assert multi.monitor() == 0
+        multi._run.assert_not_called()
+
+        mock_get_check_level.return_value = 10
+        assert multi.monitor() == 7
+        mock_is_probe.return_value = True
+        mock_get_check_level.return_value = 0
+        assert multi.monitor() == 7
+        # Only probes need the shared process index
+        multi._run.assert_has_calls([mock.call('monitor', False), mock.call('monitor', True)])
+
+    @mock.patch('SAPStartSrv.TIMER')
+    @mock.patch('ocf.is_true')
     @mock.patch('SAPStartSrv.SapStartSrv')
     @mock.patch('ocf.Agent')
     @mock.patch('ocf.get_parameter')
-    def test_main(self, mock_get_parameter, mock_ocf_agent, mock_sapstartsrv):
+    def test_main(
+            self, mock_get_parameter, mock_ocf_agent, mock_sapstartsrv, mock_is_true, mock_timer):
 
         agent = mock.Mock()
         mock_ocf_agent.return_value = agent
 
         mock_sapstartrv_intance = mock.Mock()
         mock_sapstartsrv.return_value = mock_sapstartrv_intance
-        mock_get_parameter.side_effect = ['PRD_ASCS00_virthost', None]
+        mock_get_parameter.side_effect = ['false', 'PRD_ASCS00_virthost', None]
+        mock_is_true.return_value = False
 
         SAPStartSrv.main()
 
@@ -1080,7 +3249,9 @@ class TestSAPStartSrv(unittest.TestCase):
                 name='InstanceName',
                 shortdesc='Instance name: SID_INSTANCE_VIR-HOSTNAME',
                 longdesc='The full qualified SAP instance name. e.g. HA1_ASCS00_sapha1as. '\
-                    'Usually this is the name of the SAP instance profile.',
+                    'Usually this is the name of the SAP instance profile. '\
+                    'A comma separated list of instance names manages all of them '\
+                    'concurrently with one resource.',
                 content_type='string',
                 required=True,
                 unique=True,
@@ -1094,11 +3265,33 @@ class TestSAPStartSrv(unittest.TestCase):
                 content_type='string',
                 unique=True,
                 default=''),
+            mock.call(
+                name='PROBE_SNAPSHOT_TTL',
+                shortdesc='Lifetime of the shared process snapshot used by probes',
+                longdesc='Number of seconds a snapshot of the running sapstartsrv processes is '\
+                    'shared between concurrent probes of SAPStartSrv resources on the node. '\
+                    'A value of 0 disables the snapshot and every probe scans the process table.',
+                content_type='string',
+                default='0'),
+            mock.call(
+                name='TIMING',
+                shortdesc='Log the time spent in the phases of every action',
+                longdesc='If true, the time spent in every action and its phases (initialization, '\
+                    'executables discovery, systemd checks, process lookup, external commands) '\
+                    'is logged as one json record and appended to {0}. The log is rotated '\
+                    'to {0}.1 once it exceeds 1048576 bytes.'.format(os.path.join(
+                        os.environ.get('HA_RSCTMP', '/run/resource-agents'), 'SAPStartSrv',
+                        'timing.log')),
+                content_type='boolean',
+                default='false'),
         ])
         mock_get_parameter.assert_has_calls([
+            mock.call('TIMING', 'false'),
             mock.call('InstanceName'),
             mock.call('START_PROFILE')
         ])
+        mock_is_true.assert_called_once_with('false')
+        assert mock_timer.enabled is False
         mock_sapstartsrv.assert_called_once_with('PRD_ASCS00_virthost')
 
         agent.add_action.assert_has_calls([
@@ -1107,6 +3300,12 @@ class TestSAPStartSrv(unittest.TestCase):
             mock.call(name='status', timeout=60, handler=mock_sapstartrv_intance.status),
             mock.call(
                 name='monitor', timeout=20, interval=120, handler=mock_sapstartrv_intance.monitor),
+            mock.call(
+                name='monitor', timeout=20, interval=60, depth=10,
+                handler=mock_sapstartrv_intance.monitor),
+            mock.call(
+                name='monitor', timeout=20, interval=300, depth=20,
+                handler=mock_sapstartrv_intance.monitor),
             mock.call(name='validate-all', timeout=5, handler=mock_sapstartrv_intance.validate),
         ])
 
@@ -0,0 +1,622 @@
+"""
+Benchmark harness for SAPStartSrv resource agent.
+
+Runs the agent actions and hot paths against synthetic fixtures and reports the latency
+percentiles of every benchmark, so the performance of different versions can be compared:
+
+- a fake process table with a configurable number of processes, replacing psutil.process_iter
+  and psutil.Process
+- stub systemctl, sapcontrol, sapstartsrv and attrd_updater executables sleeping the injected
+  latency. The instance state (active or inactive) is kept in a file, so the stubs start and
+  stop the instance and systemctl reports its ActiveState and MainPID
+- a fake sapstartsrv web service listening on the instance unix socket
+- optionally a fake sapstartsrv-index helper answering with the index of the process table
+- a fake /usr/sap tree with the instance executables, profile and work directory, and the
+  instance systemd unit file
+
+Every iteration uses a new SapStartSrv object, like a new agent invocation by pacemaker.
+The state directory is kept between iterations unless --cold is given.
+
+Usage:
+    python3 tests/benchmark_SAPStartSrv.py --processes 2000 --latency 0.01
+"""
+
+# pylint:disable=C0103,C0111,W0212
+
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import re
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import types
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import psutil
+
+AGENT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../ra/SAPStartSrv.in'))
+
+PERCENTILES = (50, 90, 99)
+
+STUB_SCRIPT = '''#!/bin/sh
+sleep {latency}
+{body}
+'''
+
+SYSTEMCTL_BODY = '''state=inactive
+main_pid=0
+if [ "{load_state}" = "loaded" ] && [ "$(cat {state_file})" = "active" ]; then
+    state=active
+    main_pid={main_pid}
+fi
+case "$1" in
+show)
+    shift 3
+    for unit in "$@"; do
+        [ "$first" ] && echo
+        first=1
+        echo "LoadState={load_state}"
+        echo "ActiveState=$state"
+        echo "UnitFileState={unit_file_state}"
+        echo "MainPID=$main_pid"
+    done
+    ;;
+is-active)
+    [ "$state" = "active" ]
+    ;;
+list-unit-files)
+    [ "{load_state}" = "loaded" ] && echo "$2 {unit_file_state}"
+    ;;
+start)
+    echo active > {state_file}
+    ;;
+stop)
+    echo inactive > {state_file}
+    ;;
+esac
+'''
+
+SAPSTARTSRV_BODY = '''echo active > {state_file}
+'''
+
+SAPCONTROL_BODY = '''case "$*" in
+*StopService*)
+    echo inactive > {state_file}
+    ;;
+esac
+'''
+
+SOAP_RESPONSE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:SAPControl="urn:SAPControl"><SOAP-ENV:Body>'
+    '<SAPControl:{function}Response>{body}</SAPControl:{function}Response>'
+    '</SOAP-ENV:Body></SOAP-ENV:Envelope>')
+
+SOAP_BODIES = {
+    'StopService': '',
+    'ParameterValue': '<value>HA1</value>',
+    'GetProcessList': (
+        '<process><item><name>msg_server</name><dispstatus>SAPControl-GREEN</dispstatus>'
+        '<pid>1234</pid></item><item><name>enq_server</name>'
+        '<dispstatus>SAPControl-GREEN</dispstatus><pid>1235</pid></item></process>'),
+}
+
+
+def create_ocf_module(logger):
+    '''
+    Create a minimal ocf module with the functions and constants used by the agent
+    '''
+    ocf = types.ModuleType('ocf')
+    ocf.OCF_SUCCESS = 0
+    ocf.OCF_ERR_GENERIC = 1
+    ocf.OCF_ERR_ARGS = 2
+    ocf.OCF_ERR_UNIMPLEMENTED = 3
+    ocf.OCF_ERR_PERM = 4
+    ocf.OCF_ERR_INSTALLED = 5
+    ocf.OCF_ERR_CONFIGURED = 6
+    ocf.OCF_NOT_RUNNING = 7
+    ocf.OCF_ACTION = None
+    ocf.logger = logger
+
+    def get_parameter(name, default=None):
+        return os.environ.get('OCF_RESKEY_{}'.format(name), default)
+
+    def have_binary(name):
+        return shutil.which(name) is not None
+
+    def is_probe():
+        return ocf.OCF_ACTION == 'monitor' and \
+            os.environ.get('OCF_RESKEY_CRM_meta_interval', '') == '0'
+
+    def is_true(value):
+        return value is not None and value.lower() in ('yes', 'true', '1', 'on')
+
+    ocf.get_parameter = get_parameter
+    ocf.have_binary = have_binary
+    ocf.is_probe = is_probe
+    ocf.is_true = is_true
+    return ocf
+
+
+def load_agent():
+    '''
+    Load the resource agent as SAPStartSrv module
+    '''
+    loader = importlib.machinery.SourceFileLoader('SAPStartSrv', AGENT_PATH)
+    spec = importlib.util.spec_from_file_location('SAPStartSrv', AGENT_PATH, loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module.__name__] = module
+    loader.exec_module(module)
+    return module
+
+
+class FakeProcess(object):
+    """
+    Process of the fake process table, providing the psutil.Process methods used by the agent
+
+    Args:
+        pid (int): Process id
+        name (str): Process name
+        cmdline (list): Process command line
+    """
+
+    def __init__(self, pid, name, cmdline):
+        self.pid = pid
+        self.info = {'name': name}
+        self._cmdline = cmdline
+        self._create_time = 1000000.0 + pid
+
+    def name(self):
+        return self.info['name']
+
+    def cmdline(self):
+        return list(self._cmdline)
+
+    def create_time(self):
+        return self._create_time
+
+    def ppid(self):
+        return 1
+
+
+class FakeProcessTable(object):
+    """
+    Fake process table with the given number of processes. Some of them are sapstartsrv
+    processes of other instances, the benchmarked instance process is the last one
+
+    Args:
+        size (int): Number of processes
+        exe_dir (str): Directory of the stub sapstartsrv executable
+        profile (str): Instance profile used by the benchmarked instance process
+        is_running (callable): Tell if the benchmarked instance process is in the table
+    """
+
+    def __init__(self, size, exe_dir, profile, is_running):
+        self.processes = {}
+        self.is_running = is_running
+        for pid in range(100, 100 + max(size - 1, 0)):
+            if pid % 50 == 0:
+                profile_arg = 'pf=/usr/sap/OTH/SYS/profile/OTH_D{:02d}_otherhost'.format(pid % 100)
+                self._add(FakeProcess(pid, 'sapstartsrv', [
+                    os.path.join(exe_dir, 'sapstartsrv'), profile_arg, '-D']))
+            else:
+                self._add(FakeProcess(
+                    pid, 'process{}'.format(pid), ['/usr/bin/process', str(pid)]))
+        self.instance_pid = 100 + max(size - 1, 0)
+        self.instance_process = FakeProcess(self.instance_pid, 'sapstartsrv', [
+            os.path.join(exe_dir, 'sapstartsrv'), 'pf={}'.format(profile), '-D'])
+
+    def _add(self, proc):
+        self.processes[proc.pid] = proc
+
+    def _get_processes(self):
+        processes = list(self.processes.values())
+        if self.is_running():
+            processes.append(self.instance_process)
+        return processes
+
+    def process_iter(self, attrs=None):
+        return iter(self._get_processes())
+
+    def process(self, pid):
+        if pid == self.instance_pid and self.is_running():
+            return self.instance_process
+        try:
+            return self.processes[pid]
+        except KeyError:
+            raise psutil.NoSuchProcess(pid)
+
+    def index(self):
+        '''
+        Get the sapstartsrv process index as kept by the sapstartsrv-index helper
+        '''
+        index = {}
+        for proc in self._get_processes():
+            if proc.name() != 'sapstartsrv':
+                continue
+            for item in proc.cmdline():
+                if item.startswith('pf='):
+                    index[item[len('pf='):]] = {
+                        'pid': proc.pid, 'create_time': proc.create_time(), 'unit': None}
+        return index
+
+    def patch(self):
+        '''
+        Get the patchers replacing the psutil process functions with the fake table
+        '''
+        return [
+            mock.patch('psutil.process_iter', self.process_iter),
+            mock.patch('psutil.Process', self.process)]
+
+
+class FakeSapControlHandler(socketserver.StreamRequestHandler):
+    """
+    Answer the sapstartsrv web service requests of the agent. StopService stops the instance
+    """
+
+    def handle(self):
+        headers = {}
+        if not self.rfile.readline():
+            # Connection only checking that the socket is listening
+            return
+        for line in iter(self.rfile.readline, b'\r\n'):
+            name, value = line.decode().split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        request = self.rfile.read(int(headers['content-length'])).decode()
+        function = re.search(r'<SAPControl:(\w+)', request).group(1)
+        time.sleep(self.server.latency)
+        if function == 'StopService':
+            self.server.fixture.set_running(False)
+        data = SOAP_RESPONSE.format(function=function, body=SOAP_BODIES[function]).encode()
+        self.wfile.write(
+            'HTTP/1.1 200 OK\r\nContent-Type: text/xml; charset=utf-8\r\n'
+            'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(len(data)).encode())
+        self.wfile.write(data)
+
+
+class FakeIndexHelperHandler(socketserver.StreamRequestHandler):
+    """
+    Answer the INDEX request of the agent like the sapstartsrv-index helper
+    """
+
+    def handle(self):
+        self.rfile.readline()
+        self.wfile.write(json.dumps({
+            'live': True, 'processes': self.server.table.index()}).encode() + b'\n')
+
+
+class FakeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server running the given handler in a background thread
+
+    Args:
+        socket_path (str): Path of the unix socket
+        handler (class): Request handler class
+        attributes (dict): Attributes set in the server, used by the handler
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, handler, **attributes):
+        socketserver.UnixStreamServer.__init__(self, socket_path, handler)
+        for name, value in attributes.items():
+            setattr(self, name, value)
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def write_stub(path, latency, body=''):
+    '''
+    Write an executable stub script sleeping the given latency
+    '''
+    with open(path, 'w') as stub:
+        stub.write(STUB_SCRIPT.format(latency=latency, body=body))
+    os.chmod(path, 0o755)
+
+
+class Fixture(object):
+    """
+    Fake /usr/sap tree, stub executables and state directory of the benchmark
+
+    Args:
+        root (str): Root directory of the fixture
+        instance (str): Instance name as SID_INSTANCE_VIR-HOSTNAME
+        latency (float): Seconds slept by every stub executable call
+        systemd (bool): Install the instance systemd unit, managed by the stub systemctl
+        main_pid (int): MainPID reported by systemctl for the active unit
+    """
+
+    def __init__(self, root, instance, latency, systemd=True, main_pid=0):
+        sid, instance_name, virtual_host = instance.split('_', 2)
+        instance_number = instance_name[-2:]
+        self.root = root
+        self.exe_dir = os.path.join(root, 'usr/sap', sid, instance_name, 'exe')
+        self.profile_dir = os.path.join(root, 'usr/sap', sid, 'SYS/profile')
+        self.work_dir = os.path.join(root, 'usr/sap', sid, instance_name, 'work')
+        self.bin_dir = os.path.join(root, 'usr/bin')
+        self.unit_dir = os.path.join(root, 'etc/systemd/system')
+        self.runtime_unit_dir = os.path.join(root, 'run/systemd/system')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.state_dir = os.path.join(root, 'run/resource-agents/SAPStartSrv')
+        self.instance_state = os.path.join(root, 'instance.state')
+        self.profile = os.path.join(
+            self.profile_dir, '{}_{}_{}'.format(sid, instance_name, virtual_host))
+        self.systemctl = os.path.join(self.bin_dir, 'systemctl')
+        self.attrd_updater = os.path.join(self.bin_dir, 'attrd_updater')
+        self.sapstream_socket = os.path.join(self.tmp_dir, '.sapstream5{}13')
+        self.sapstream_secure_socket = os.path.join(self.tmp_dir, '.sapstream5{}14')
+        self.socket_path = self.sapstream_socket.format(instance_number)
+        self.index_helper_socket = os.path.join(root, 'run/sapstartsrv-index.sock')
+
+        for directory in (
+                self.exe_dir, self.profile_dir, self.work_dir, self.bin_dir, self.unit_dir,
+                self.runtime_unit_dir, self.tmp_dir):
+            os.makedirs(directory)
+        with open(self.profile, 'w') as profile:
+            profile.write('SAPSYSTEMNAME = {}\n'.format(sid))
+        if systemd:
+            with open(os.path.join(
+                    self.unit_dir, 'SAP{}_{}.service'.format(sid, instance_number)), 'w'):
+                pass
+        write_stub(os.path.join(self.exe_dir, 'sapstartsrv'), latency, SAPSTARTSRV_BODY.format(
+            state_file=self.instance_state))
+        write_stub(os.path.join(self.exe_dir, 'sapcontrol'), latency, SAPCONTROL_BODY.format(
+            state_file=self.instance_state))
+        write_stub(self.systemctl, latency, SYSTEMCTL_BODY.format(
+            load_state='loaded' if systemd else 'not-found',
+            unit_file_state='disabled' if systemd else '',
+            state_file=self.instance_state, main_pid=main_pid))
+        write_stub(self.attrd_updater, latency)
+        self.set_running(True)
+
+    def set_running(self, running):
+        '''
+        Start or stop the instance
+        '''
+        with open(self.instance_state, 'w') as state:
+            state.write('active\n' if running else 'inactive\n')
+
+    def is_running(self):
+        with open(self.instance_state) as state:
+            return state.read().strip() == 'active'
+
+    def environment(self):
+        '''
+        Get the OCF environment pointing the agent to the fake tree
+        '''
+        return {
+            'OCF_RESKEY_DIR_EXECUTABLE': self.exe_dir,
+            'OCF_RESKEY_DIR_PROFILE': self.profile_dir,
+            'OCF_RESKEY_CRM_meta_timeout': '60000',
+        }
+
+    def patch(self, agent):
+        '''
+        Get the patchers pointing the agent paths to the fake tree
+        '''
+        return [
+            mock.patch.object(agent, 'STATE_DIR', self.state_dir),
+            mock.patch.object(agent, 'SYSTEMCTL', self.systemctl),
+            mock.patch.object(agent, 'SYSTEMD_UNIT_DIR', self.unit_dir),
+            mock.patch.object(agent, 'SYSTEMD_RUNTIME_UNIT_DIR', self.runtime_unit_dir),
+            mock.patch.object(agent, 'ATTRD_UPDATER', self.attrd_updater),
+            mock.patch.object(agent, 'SAPSTREAM_SOCKET', self.sapstream_socket),
+            mock.patch.object(agent, 'SAPSTREAM_SECURE_SOCKET', self.sapstream_secure_socket),
+            mock.patch.object(agent, 'INDEX_HELPER_SOCKET', self.index_helper_socket),
+            # The fake instance process exits once StopService stopped the instance
+            mock.patch.object(
+                agent, 'wait_for_process_exit', lambda proc, timeout: not self.is_running()),
+            mock.patch.object(
+                agent.SapStartSrv, '_get_pid_file',
+                lambda instance: os.path.join(self.work_dir, 'sapstartsrv.pid')),
+        ]
+
+    def write_pid_file(self, pid):
+        with open(os.path.join(self.work_dir, 'sapstartsrv.pid'), 'w') as pid_file:
+            pid_file.write('{}\n'.format(pid))
+
+    def reset_state(self):
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+
+def percentile(samples, value):
+    '''
+    Get the given percentile of the sorted samples using the nearest rank
+    '''
+    rank = max(int(round(value / 100.0 * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def get_benchmarks(agent, ocf):
+    '''
+    Get the benchmarked actions and hot paths with the instance state they need (None keeps
+    the state given in the options). Every benchmark gets a new SapStartSrv object
+    '''
+    def action(name, interval='0', check_level=None):
+        def run(instance):
+            ocf.OCF_ACTION = name
+            os.environ['OCF_RESKEY_CRM_meta_interval'] = interval
+            if check_level is None:
+                os.environ.pop('OCF_RESKEY_OCF_CHECK_LEVEL', None)
+            else:
+                os.environ['OCF_RESKEY_OCF_CHECK_LEVEL'] = str(check_level)
+            handler = {'start': instance.start, 'stop': instance.stop,
+                       'monitor': instance.monitor, 'status': instance.status,
+                       'validate-all': instance.validate}[name]
+            return handler()
+        return run
+
+    def hot_path(method, lookup=False):
+        def run(instance):
+            ocf.OCF_ACTION = 'start'
+            os.environ['OCF_RESKEY_CRM_meta_interval'] = '0'
+            instance._parse_instance_name()
+            if lookup:
+                return method(instance, re.compile(instance._get_profile_pattern()))
+            return method(instance)
+        return run
+
+    return [
+        ('probe', action('monitor'), None),
+        ('monitor', action('monitor', interval='120000'), None),
+        ('monitor-liveness', action(
+            'monitor', interval='60000', check_level=agent.CHECK_LEVEL_LIVENESS), True),
+        ('monitor-services', action(
+            'monitor', interval='300000', check_level=agent.CHECK_LEVEL_SERVICES), True),
+        ('status', action('status'), None),
+        ('validate-all', action('validate-all'), None),
+        ('start', action('start'), False),
+        ('start-running', action('start'), True),
+        ('stop', action('stop'), True),
+        ('stop-stopped', action('stop'), False),
+        ('_get_status', hot_path(agent.SapStartSrv._get_status), None),
+        ('_find_process_by_unit', hot_path(
+            agent.SapStartSrv._find_process_by_unit, lookup=True), None),
+        ('_find_process_by_helper', hot_path(
+            agent.SapStartSrv._find_process_by_helper, lookup=True), None),
+        ('_find_executables', hot_path(agent.SapStartSrv._find_executables), None),
+        ('_prepare_environment', hot_path(agent.SapStartSrv._prepare_environment), None),
+        ('_chk_systemd_support', hot_path(agent.SapStartSrv._chk_systemd_support), None),
+        ('_is_unit_active', hot_path(agent.SapStartSrv._is_unit_active), None),
+    ]
+
+
+def run_benchmarks(options):
+    '''
+    Run every benchmark the given number of iterations and get the sorted latencies
+    '''
+    logger = logging.getLogger('SAPStartSrv')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    ocf = create_ocf_module(logger)
+    sys.modules['ocf'] = ocf
+    agent = load_agent()
+
+    root = tempfile.mkdtemp(prefix='sapstartsrv-benchmark-')
+    try:
+        instance_pid = 100 + max(options.processes - 1, 0)
+        fixture = Fixture(
+            root, options.instance, options.latency, not options.sys5, instance_pid)
+        table = FakeProcessTable(
+            options.processes, fixture.exe_dir, fixture.profile, fixture.is_running)
+        if options.pid_file:
+            fixture.write_pid_file(table.instance_pid)
+
+        servers = [FakeServer(
+            fixture.socket_path, FakeSapControlHandler, fixture=fixture,
+            latency=options.latency)]
+        if options.index_helper:
+            servers.append(FakeServer(
+                fixture.index_helper_socket, FakeIndexHelperHandler, table=table))
+        patchers = table.patch() + fixture.patch(agent) + [
+            mock.patch.dict(os.environ, fixture.environment())]
+        for server in servers:
+            server.__enter__()
+        for patcher in patchers:
+            patcher.start()
+        try:
+            results = []
+            for name, benchmark, running in get_benchmarks(agent, ocf):
+                if options.benchmark and name not in options.benchmark:
+                    continue
+                samples = []
+                for _ in range(options.iterations):
+                    if options.cold:
+                        fixture.reset_state()
+                    fixture.set_running(not options.stopped if running is None else running)
+                    instance = agent.SapStartSrv(options.instance)
+                    # Every iteration stands for a new agent process with its own deadline
+                    agent.ACTION_START = time.monotonic()
+                    start = time.perf_counter()
+                    benchmark(instance)
+                    samples.append(time.perf_counter() - start)
+                results.append((name, sorted(samples)))
+            return results
+        finally:
+            for patcher in reversed(patchers):
+                patcher.stop()
+            for server in servers:
+                server.__exit__()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def report(results, as_json=False):
+    '''
+    Print the latency percentiles of every benchmark in milliseconds
+    '''
+    rows = []
+    for name, samples in results:
+        row = {'benchmark': name, 'iterations': len(samples)}
+        for value in PERCENTILES:
+            row['p{}'.format(value)] = round(percentile(samples, value) * 1000, 3)
+        row['max'] = round(samples[-1] * 1000, 3)
+        rows.append(row)
+
+    if as_json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    columns = ['p{}'.format(value) for value in PERCENTILES] + ['max']
+    print('{:<24}{:>8}'.format('benchmark (ms)', 'runs') +
+          ''.join('{:>12}'.format(column) for column in columns))
+    for row in rows:
+        print('{:<24}{:>8}'.format(row['benchmark'], row['iterations']) +
+              ''.join('{:>12.3f}'.format(row[column]) for column in columns))
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark SAPStartSrv resource agent actions against synthetic fixtures')
+    parser.add_argument('--instance', default='HA1_ASCS00_sapha1as',
+                        help='Instance name (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=1000,
+                        help='Number of processes in the fake process table (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds slept by every stub executable call (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='Iterations of every benchmark (default: %(default)s)')
+    parser.add_argument('--benchmark', action='append',
+                        help='Run only the given benchmark. Can be given several times')
+    parser.add_argument('--cold', action='store_true',
+                        help='Remove the agent state directory before every iteration')
+    parser.add_argument('--stopped', action='store_true',
+                        help='Benchmark an instance without running sapstartsrv process')
+    parser.add_argument('--pid-file', action='store_true',
+                        help='Write the sapstartsrv PID file to the instance work directory')
+    parser.add_argument('--sys5', action='store_true',
+                        help='Make the stub systemctl report no instance unit')
+    parser.add_argument('--index-helper', action='store_true',
+                        help='Run a fake sapstartsrv-index helper answering the process index')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as json')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_arguments(args)
+    report(run_benchmarks(options), options.json)
+
+
+if __name__ == '__main__':
+    main()
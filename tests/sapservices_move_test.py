@@ -0,0 +1,485 @@
+"""
+Unitary tests for sapservices-move.
+
+:organization: SUSE LLC
+
+:since: 2026-10-18
+"""
+
+# pylint:disable=C0103,C0111,W0212
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+try:
+    import imp
+    load_source = imp.load_source
+except ImportError:
+    # Python >= 3.12
+    import importlib.util
+    import importlib.machinery
+
+    def load_source(modname, filename):
+        loader = importlib.machinery.SourceFileLoader(modname, filename)
+        spec = importlib.util.spec_from_file_location(modname, filename, loader=loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module.__name__] = module
+        loader.exec_module(module)
+        return module
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sapservices_move = load_source(
+    'sapservices_move',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '../sbin/sapservices-move.in')))
+
+
+ASCS_ENTRY = (
+    'LD_LIBRARY_PATH=/usr/sap/HA1/ASCS00/exe:$LD_LIBRARY_PATH; export LD_LIBRARY_PATH; '
+    '/usr/sap/HA1/ASCS00/exe/sapstartsrv pf=/usr/sap/HA1/SYS/profile/HA1_ASCS00_sapha1as '
+    '-D -u ha1adm\n')
+ERS_ENTRY = (
+    'LD_LIBRARY_PATH=/usr/sap/HA1/ERS10/exe:$LD_LIBRARY_PATH; export LD_LIBRARY_PATH; '
+    '/usr/sap/HA1/ERS10/exe/sapstartsrv pf=/usr/sap/HA1/SYS/profile/HA1_ERS10_sapha1er '
+    '-D -u ha1adm\n')
+SYSTEMD_ENTRY = (
+    'systemctl --no-ask-password start SAPHA1_20 '
+    '# sapstartsrv pf=/usr/sap/HA1/SYS/profile/HA1_D20_sapha1d1\n')
+COMMENT = (
+    '#LD_LIBRARY_PATH=/usr/sap/QAS/ASCS01/exe:$LD_LIBRARY_PATH; export LD_LIBRARY_PATH; '
+    '/usr/sap/QAS/ASCS01/exe/sapstartsrv pf=/usr/sap/QAS/SYS/profile/QAS_ASCS01_qas '
+    '-D -u qasadm\n')
+SAPSERVICES = '#!/bin/sh\n' + ASCS_ENTRY + ERS_ENTRY + SYSTEMD_ENTRY + COMMENT
+MANAGED = {('HA1', '00'), ('HA1', '10')}
+HIDDEN = '#!/bin/sh\n' + SYSTEMD_ENTRY + COMMENT
+
+
+class Crash(Exception):
+    """
+    Simulated crash of sapservices-move
+    """
+
+
+class TestSapservicesMove(unittest.TestCase):
+    """
+    Unitary tests for sapservices-move, working on a temporary directory
+    """
+
+    def setUp(self):
+        """
+        Test setUp.
+        """
+        self._dir = tempfile.mkdtemp()
+        self._sapservices = os.path.join(self._dir, 'sapservices')
+        self._moved = self._sapservices + '.moved'
+        self._journal = self._sapservices + '.journal'
+        os.mkdir(os.path.join(self._dir, 'system'))
+        os.mkdir(os.path.join(self._dir, 'run'))
+        self._patchers = [
+            mock.patch.object(sapservices_move, 'SAPSERVICES', self._sapservices),
+            mock.patch.object(sapservices_move, 'SAPSERVICES_MOVED', self._moved),
+            mock.patch.object(
+                sapservices_move, 'SAPSERVICES_EMPTY', self._sapservices + '.empty'),
+            mock.patch.object(sapservices_move, 'JOURNAL', self._journal),
+            mock.patch.object(
+                sapservices_move, 'SYSTEMD_UNIT_DIR', os.path.join(self._dir, 'system')),
+            mock.patch.object(
+                sapservices_move, 'RUNTIME_UNIT_DIR', os.path.join(self._dir, 'run')),
+            mock.patch.object(
+                sapservices_move, 'SYSTEMCTL', os.path.join(self._dir, 'systemctl')),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+        self._print_patcher = mock.patch('builtins.print')
+        self._print = self._print_patcher.start()
+        self._write(self._sapservices, SAPSERVICES)
+
+    def tearDown(self):
+        """
+        Test tearDown.
+        """
+        self._print_patcher.stop()
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+        shutil.rmtree(self._dir)
+
+    @staticmethod
+    def _write(path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            return f.read()
+
+    @staticmethod
+    def _crash_on(name, call=1):
+        '''
+        Let the given call of an os function crash, the other calls are done
+        '''
+        function = getattr(os, name)
+        calls = []
+
+        def crash(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == call:
+                raise Crash()
+            return function(*args, **kwargs)
+
+        return mock.patch.object(sapservices_move.os, name, side_effect=crash)
+
+    def _assert_hidden(self):
+        assert self._read(self._sapservices) == HIDDEN
+        assert self._read(self._moved) == SAPSERVICES
+        assert not os.path.exists(self._journal)
+
+    def _assert_unhidden(self):
+        assert self._read(self._sapservices) == SAPSERVICES
+        assert not os.path.exists(self._moved)
+        assert not os.path.exists(self._journal)
+
+    def test_write_read_journal(self):
+        assert sapservices_move.read_journal() == (None, None)
+
+        sapservices_move.write_journal('hide', MANAGED)
+        assert sapservices_move.read_journal() == ('hide', MANAGED)
+        assert not os.path.exists(self._journal + '.tmp')
+
+        sapservices_move.write_journal('unhide')
+        assert sapservices_move.read_journal() == ('unhide', None)
+
+        sapservices_move.clear_journal()
+        sapservices_move.clear_journal()
+        assert sapservices_move.read_journal() == (None, None)
+
+    def test_read_journal_incomplete(self):
+        self._write(self._journal, '{"operation": "hi')
+        assert sapservices_move.read_journal() == (None, None)
+
+    def test_hide_unhide(self):
+        summary = sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+        assert summary['result'] == 'hidden'
+        assert summary['entries'] == 3
+        assert summary['hidden'] == 2
+        assert os.stat(self._sapservices).st_mode == os.stat(self._moved).st_mode
+
+        summary = sapservices_move.run('unhide')
+        self._assert_unhidden()
+        assert summary['result'] == 'unhidden'
+
+    def test_hide_repeated(self):
+        sapservices_move.run('hide', MANAGED)
+        summary = sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+        assert summary['result'] == 'skipped'
+
+    def test_unhide_repeated(self):
+        sapservices_move.run('hide', MANAGED)
+        sapservices_move.run('unhide')
+        summary = sapservices_move.run('unhide')
+        self._assert_unhidden()
+        assert summary['result'] == 'skipped'
+
+    def test_unhide_changed(self):
+        sapservices_move.run('hide', MANAGED)
+        # Entry registered with sapstartsrv -reg and comment removed while hidden
+        registered = (
+            'systemctl --no-ask-password start SAPQAS_01 '
+            '# sapstartsrv pf=/usr/sap/QAS/SYS/profile/QAS_ASCS01_qas\n')
+        changed = '#!/bin/sh\n' + SYSTEMD_ENTRY + registered
+        self._write(self._sapservices, changed)
+
+        summary = sapservices_move.run('unhide')
+        assert self._read(self._sapservices) == changed + ASCS_ENTRY + ERS_ENTRY
+        assert not os.path.exists(self._moved)
+        assert summary['result'] == 'merged'
+        assert summary['restored'] == 2
+
+        summary = sapservices_move.run('unhide')
+        assert summary['result'] == 'skipped'
+
+    def test_unhide_changed_crash(self):
+        sapservices_move.run('hide', MANAGED)
+        changed = HIDDEN + ASCS_ENTRY
+        self._write(self._sapservices, changed)
+        with self._crash_on('unlink'):
+            with self.assertRaises(Crash):
+                sapservices_move.run('unhide')
+        assert self._read(self._sapservices) == changed + ERS_ENTRY
+        assert self._read(self._moved) == SAPSERVICES
+
+        # The interrupted unhide is completed, the entries are not added twice
+        sapservices_move.run('unhide')
+        assert self._read(self._sapservices) == changed + ERS_ENTRY
+        assert not os.path.exists(self._moved)
+        assert not os.path.exists(self._journal)
+
+    def test_crash_after_link(self):
+        # The first replace writes the journal
+        with self._crash_on('replace', call=2):
+            with self.assertRaises(Crash):
+                sapservices_move.run('hide', MANAGED)
+        assert self._read(self._sapservices) == SAPSERVICES
+        assert os.path.exists(self._moved + '.tmp')
+        assert sapservices_move.read_journal() == ('hide', MANAGED)
+
+        sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+        assert not os.path.exists(self._moved + '.tmp')
+
+    def test_crash_after_replacing_moved(self):
+        with self._crash_on('chmod'):
+            with self.assertRaises(Crash):
+                sapservices_move.run('hide', MANAGED)
+        assert self._read(self._sapservices) == SAPSERVICES
+        assert self._read(self._moved) == SAPSERVICES
+
+        # The next run completes the hide before unhiding
+        sapservices_move.run('unhide')
+        self._assert_unhidden()
+
+    def test_crash_before_replacing_sapservices(self):
+        with self._crash_on('replace', call=3):
+            with self.assertRaises(Crash):
+                sapservices_move.run('hide', MANAGED)
+        assert self._read(self._sapservices) == SAPSERVICES
+        assert self._read(self._moved) == SAPSERVICES
+        assert self._read(self._sapservices + '.empty') == HIDDEN
+
+        sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+
+    def test_crash_before_clear_journal(self):
+        with mock.patch.object(sapservices_move, 'clear_journal', side_effect=Crash()):
+            with self.assertRaises(Crash):
+                sapservices_move.run('hide', MANAGED)
+        assert self._read(self._sapservices) == HIDDEN
+        assert sapservices_move.read_journal() == ('hide', MANAGED)
+
+        sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+
+    def test_crash_during_unhide(self):
+        sapservices_move.run('hide', MANAGED)
+        with mock.patch.object(sapservices_move, 'clear_journal', side_effect=Crash()):
+            with self.assertRaises(Crash):
+                sapservices_move.run('unhide')
+        assert sapservices_move.read_journal() == ('unhide', None)
+
+        # The interrupted unhide is completed before the requested hide
+        summary = sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+        assert summary['result'] == 'hidden'
+
+    def test_sapservices_missing(self):
+        # Layout left by a crash of a previous version between its two renames
+        os.rename(self._sapservices, self._moved)
+
+        sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+
+        os.unlink(self._sapservices)
+        sapservices_move.run('unhide')
+        self._assert_unhidden()
+
+    def test_print_summary(self):
+        sapservices_move.print_summary('hide', {'result': 'hidden'}, 0)
+
+        output = self._print.call_args[0][0]
+        record = json.loads(output.split(': ', 1)[1])
+        assert record['operation'] == 'hide'
+        assert record['result'] == 'hidden'
+        assert record['file'] == self._sapservices
+
+    def test_hide_changed_instances(self):
+        sapservices_move.run('hide', {('HA1', '00')})
+        assert self._read(self._sapservices) == \
+            '#!/bin/sh\n' + ERS_ENTRY + SYSTEMD_ENTRY + COMMENT
+
+        # Hidden again with more instances, without unhide in between
+        summary = sapservices_move.run('hide', MANAGED)
+        self._assert_hidden()
+        assert summary['result'] == 'hidden'
+        assert summary['hidden'] == 2
+
+        # and with less instances
+        sapservices_move.run('hide', {('HA1', '10')})
+        assert self._read(self._sapservices) == \
+            '#!/bin/sh\n' + ASCS_ENTRY + SYSTEMD_ENTRY + COMMENT
+        assert self._read(self._moved) == SAPSERVICES
+
+        sapservices_move.run('unhide')
+        self._assert_unhidden()
+
+    def test_parse_entry(self):
+        assert sapservices_move.parse_entry(ASCS_ENTRY) == ('HA1', '00')
+        assert sapservices_move.parse_entry(ERS_ENTRY) == ('HA1', '10')
+        assert sapservices_move.parse_entry(SYSTEMD_ENTRY) == ('HA1', '20')
+        assert sapservices_move.parse_entry(
+            'systemctl --no-ask-password start SAPQAS_01\n') == ('QAS', '01')
+        assert sapservices_move.parse_entry(COMMENT) is None
+        assert sapservices_move.parse_entry('  # ' + SYSTEMD_ENTRY) is None
+        assert sapservices_move.parse_entry('#!/bin/sh\n') is None
+        assert sapservices_move.parse_entry('\n') is None
+
+    def test_parse_instance_name(self):
+        assert sapservices_move.parse_instance_name('HA1_ASCS00_sapha1as') == ('HA1', '00')
+        assert sapservices_move.parse_instance_name(' HA1_D20_sapha1d1 ') == ('HA1', '20')
+        assert sapservices_move.parse_instance_name('HA1_ASCS_sapha1as') is None
+        assert sapservices_move.parse_instance_name('') is None
+
+    def test_filter_entries(self):
+        assert sapservices_move.filter_entries(SAPSERVICES, MANAGED) == (
+            HIDDEN, 3, MANAGED)
+        assert sapservices_move.filter_entries(SAPSERVICES, None) == (
+            '#!/bin/sh\n' + COMMENT, 3, MANAGED | {('HA1', '20')})
+        assert sapservices_move.filter_entries(SAPSERVICES, {('QAS', '01')}) == (
+            SAPSERVICES, 3, set())
+
+    def _write_cib(self):
+        cib = os.path.join(self._dir, 'cib.xml')
+        self._write(cib, (
+            '<cib><configuration><resources>'
+            '<group id="grp"><primitive id="rsc_ascs" class="ocf" provider="suse" '
+            'type="SAPStartSrv"><instance_attributes id="ia_ascs">'
+            '<nvpair id="nv_ascs" name="InstanceName" value="HA1_ASCS00_sapha1as"/>'
+            '</instance_attributes></primitive></group>'
+            '<primitive id="rsc_multi" class="ocf" provider="suse" type="SAPStartSrv">'
+            '<instance_attributes id="ia_multi"><nvpair id="nv_multi" name="InstanceName" '
+            'value="HA1_ERS10_sapha1er,QAS_ASCS01_qas"/></instance_attributes></primitive>'
+            '<primitive id="rsc_d20" class="ocf" provider="heartbeat" type="SAPInstance">'
+            '<instance_attributes id="ia_d20"><nvpair id="nv_d20" name="InstanceName" '
+            'value="HA1_D20_sapha1d1"/></instance_attributes></primitive>'
+            '</resources></configuration></cib>'))
+        return cib
+
+    def test_get_cib_instances(self):
+        assert sapservices_move.get_cib_instances(self._write_cib()) == [
+            'HA1_ASCS00_sapha1as', 'HA1_ERS10_sapha1er', 'QAS_ASCS01_qas']
+
+    def test_get_cib_instances_unreadable(self):
+        assert sapservices_move.get_cib_instances(os.path.join(self._dir, 'missing')) == []
+
+        cib = os.path.join(self._dir, 'cib.xml')
+        self._write(cib, '<cib><configuration>')
+        assert sapservices_move.get_cib_instances(cib) == []
+
+    def test_get_managed_instances(self):
+        cib = self._write_cib()
+        assert sapservices_move.get_managed_instances(None, cib) == \
+            MANAGED | {('QAS', '01')}
+        # --instances takes precedence over the CIB
+        assert sapservices_move.get_managed_instances('HA1_D20_sapha1d1, invalid,', cib) == \
+            {('HA1', '20')}
+        # all entries are hidden if no instance is known
+        assert sapservices_move.get_managed_instances(
+            None, os.path.join(self._dir, 'missing')) is None
+        assert sapservices_move.get_managed_instances('invalid', cib) is None
+
+    def test_do_hide(self):
+        sapservices_move.do_hide(None, self._write_cib())
+        self._assert_hidden()
+
+        sapservices_move.do_unhide()
+        self._assert_unhidden()
+
+        sapservices_move.do_hide(None, os.path.join(self._dir, 'missing'))
+        assert self._read(self._sapservices) == '#!/bin/sh\n' + COMMENT
+
+    def _write_systemctl(self, returncode=0):
+        '''
+        Write a systemctl stub logging its arguments and masking the units in RUNTIME_UNIT_DIR
+        '''
+        systemctl = os.path.join(self._dir, 'systemctl')
+        self._write(systemctl, (
+            '#!/bin/sh\n'
+            'echo "$@" >> {log}\n'
+            '[ {rc} -eq 0 ] || exit {rc}\n'
+            'action=$3; shift 3\n'
+            'for unit in "$@"; do\n'
+            '  if [ "$action" = mask ]; then ln -s /dev/null {run}/$unit\n'
+            '  else rm -f {run}/$unit; fi\n'
+            'done\n').format(
+                log=os.path.join(self._dir, 'systemctl.log'), rc=returncode,
+                run=os.path.join(self._dir, 'run')))
+        os.chmod(systemctl, 0o755)
+
+    def _read_systemctl_calls(self):
+        try:
+            return self._read(os.path.join(self._dir, 'systemctl.log')).splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _install_units(self, *units):
+        for unit in units:
+            self._write(os.path.join(self._dir, 'system', unit), '')
+
+    def test_get_systemd_units(self):
+        self._install_units('SAPHA1_00.service', 'SAPHA1_20.service')
+        assert sapservices_move.get_systemd_units(
+            {('HA1', '20'), ('HA1', '00'), ('HA1', '10')}) == \
+            ['SAPHA1_00.service', 'SAPHA1_20.service']
+        assert sapservices_move.get_systemd_units(set()) == []
+
+    def test_mask_units(self):
+        self._write_systemctl()
+        self._install_units('SAPHA1_00.service', 'SAPHA1_10.service')
+
+        summary = sapservices_move.run('hide', MANAGED)
+        assert summary['masked'] == ['SAPHA1_00.service', 'SAPHA1_10.service']
+        assert 'error' not in summary
+        assert sapservices_move.is_runtime_masked('SAPHA1_00.service')
+
+        # Units already masked are not masked again
+        summary = sapservices_move.run('hide', MANAGED)
+        assert summary['masked'] == []
+
+        # The masks are kept until the agent starts the unit or the node reboots
+        summary = sapservices_move.run('unhide')
+        assert 'unmasked' not in summary
+        assert sapservices_move.is_runtime_masked('SAPHA1_00.service')
+
+        # One systemctl call for all the units
+        assert self._read_systemctl_calls() == [
+            '--runtime --no-ask-password mask SAPHA1_00.service SAPHA1_10.service']
+
+    def test_mask_units_error(self):
+        self._write_systemctl(returncode=1)
+        self._install_units('SAPHA1_00.service')
+
+        summary = sapservices_move.run('hide', MANAGED)
+
+        # sapservices is hidden and the failure is reported
+        self._assert_hidden()
+        assert summary['masked'] == ['SAPHA1_00.service']
+        assert summary['error'].startswith('systemctl mask failed: ')
+
+    def test_mask_units_systemctl_missing(self):
+        self._install_units('SAPHA1_00.service')
+
+        summary = sapservices_move.run('hide', MANAGED)
+
+        self._assert_hidden()
+        assert summary['error'].startswith('systemctl mask failed: ')
+
+    def test_do_hide_error(self):
+        self._write_systemctl(returncode=1)
+        self._install_units('SAPHA1_00.service')
+
+        with self.assertRaises(SystemExit) as exit_error:
+            sapservices_move.do_hide('HA1_ASCS00_sapha1as', None)
+        assert exit_error.exception.code == 1
+
+        output = self._print.call_args[0][0]
+        record = json.loads(output.split(': ', 1)[1])
+        assert record['result'] == 'hidden'
+        assert record['error'].startswith('systemctl mask failed: ')
@@ -0,0 +1,237 @@
+"""
+Unitary tests for the sapstartsrv-index helper.
+
+:organization: SUSE LLC
+
+:since: 2026-10-18
+"""
+
+# pylint:disable=C0103,C0111,W0212
+
+import os
+import sys
+import json
+import errno
+import socket
+import unittest
+
+try:
+    import imp
+    load_source = imp.load_source
+except ImportError:
+    # Python >= 3.12
+    import importlib.util
+    import importlib.machinery
+
+    def load_source(modname, filename):
+        loader = importlib.machinery.SourceFileLoader(modname, filename)
+        spec = importlib.util.spec_from_file_location(modname, filename, loader=loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module.__name__] = module
+        loader.exec_module(module)
+        return module
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+index_helper = load_source(
+    'sapstartsrv_index',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '../sbin/sapstartsrv-index.in')))
+
+
+def pack_event(what, *ids):
+    '''
+    Pack a netlink message with one cn_proc event
+    '''
+    event = index_helper.PROC_EVENT_HEADER.pack(what, 0, 0) + \
+        index_helper.PROC_EVENT_IDS.pack(*ids)
+    payload = index_helper.CN_MSG_HEADER.pack(
+        index_helper.CN_IDX_PROC, index_helper.CN_VAL_PROC, 0, 0, len(event), 0) + event
+    return index_helper.NLMSG_HEADER.pack(
+        index_helper.NLMSG_HEADER.size + len(payload), index_helper.NLMSG_DONE, 0, 0, 0) + \
+        payload
+
+
+def fork_event(parent, child):
+    return pack_event(index_helper.PROC_EVENT_FORK, parent, parent, child, child)
+
+
+def exec_event(pid):
+    return pack_event(index_helper.PROC_EVENT_EXEC, pid, pid, 0, 0)
+
+
+def exit_event(pid):
+    return pack_event(index_helper.PROC_EVENT_EXIT, pid, pid, 0, 0)
+
+
+def entry(pid, profile, create_time=100.0):
+    return {'pid': pid, 'create_time': create_time, 'profile': profile, 'unit': None}
+
+
+class TestProcessIndex(unittest.TestCase):
+    """
+    Unitary tests for the process index kept up to date with process events
+    """
+
+    def setUp(self):
+        """
+        Test setUp. get_process_entry answers from self._processes
+        """
+        self._processes = {}
+        self._entry_patcher = mock.patch.object(
+            index_helper, 'get_process_entry', side_effect=self._processes.get)
+        self._entry_patcher.start()
+        self._index = index_helper.ProcessIndex()
+        self._index.events = mock.Mock()
+
+    def tearDown(self):
+        """
+        Test tearDown.
+        """
+        self._entry_patcher.stop()
+
+    def test_handle_event_exec(self):
+        self._processes[10] = entry(10, '/usr/sap/PRD/SYS/profile/PRD_ASCS00_virthost')
+
+        self._index._handle_event(exec_event(10))
+        self._index._handle_event(exec_event(11))
+
+        assert list(self._index.processes) == [10]
+
+    def test_handle_event_exit(self):
+        self._index.processes[10] = entry(10, 'profile')
+
+        self._index._handle_event(exit_event(10))
+        self._index._handle_event(exit_event(11))
+
+        assert self._index.processes == {}
+
+    def test_handle_event_thread(self):
+        self._processes[10] = entry(10, 'profile')
+        self._index.processes[10] = entry(10, 'profile')
+
+        # Threads exiting or created by an indexed process do not change the index
+        self._index._handle_event(
+            pack_event(index_helper.PROC_EVENT_EXIT, 12, 10, 0, 0))
+        self._index._handle_event(
+            pack_event(index_helper.PROC_EVENT_FORK, 10, 10, 13, 10))
+
+        assert list(self._index.processes) == [10]
+
+    def test_handle_event_fork_daemonize(self):
+        self._index.processes[10] = entry(10, 'profile', 100.0)
+        self._processes[11] = entry(11, 'profile', 101.0)
+
+        self._index._handle_event(fork_event(10, 11))
+        assert list(self._index.processes) == [10]
+
+        # sapstartsrv -D: the parent exits, the forked daemon is indexed
+        self._index._handle_event(exit_event(10))
+        assert list(self._index.processes) == [11]
+        assert self._index.forked == {}
+
+    def test_handle_event_fork_child(self):
+        self._index.processes[10] = entry(10, 'profile', 100.0)
+        self._processes[11] = entry(11, 'profile', 101.0)
+        self._processes[12] = entry(12, 'profile', 102.0)
+
+        # A child of the running daemon is never indexed while it has the parent's profile
+        self._index._handle_event(fork_event(10, 11))
+        self._index._handle_event(exit_event(11))
+        self._index._handle_event(fork_event(10, 12))
+        del self._processes[12]
+        self._index._handle_event(exec_event(12))
+
+        assert list(self._index.processes) == [10]
+        assert self._index.forked == {}
+
+    def test_handle_event_fork_not_indexed(self):
+        self._index._handle_event(fork_event(10, 11))
+        assert self._index.forked == {}
+
+    def test_handle_event_truncated(self):
+        self._index._handle_event(exec_event(10)[:40])
+        assert self._index.processes == {}
+
+    def test_read_events(self):
+        self._processes[10] = entry(10, 'profile')
+        self._processes[20] = entry(20, 'profile2')
+        self._index.events.recv.side_effect = [
+            exec_event(10) + exec_event(20), exit_event(20), BlockingIOError()]
+
+        self._index.read_events()
+
+        assert list(self._index.processes) == [10]
+
+    def test_read_events_lost(self):
+        self._index.scan = mock.Mock()
+        self._index.events.recv.side_effect = [
+            OSError(errno.ENOBUFS, 'No buffer space available'), BlockingIOError()]
+
+        self._index.read_events()
+
+        self._index.scan.assert_called_once_with()
+
+    def test_read_events_error(self):
+        self._index.events.recv.side_effect = OSError(errno.EBADF, 'Bad file descriptor')
+
+        with self.assertRaises(OSError):
+            self._index.read_events()
+
+    def test_read_events_not_subscribed(self):
+        events = self._index.events
+        self._index.events = None
+
+        self._index.read_events()
+
+        assert events.recv.call_count == 0
+
+    def test_dump(self):
+        self._index.live = True
+        self._index.processes[10] = entry(10, 'profile', 100.0)
+        self._index.processes[20] = entry(20, 'profile2', 200.0)
+
+        assert self._index.dump() == {
+            'live': True,
+            'processes': {
+                'profile': {'pid': 10, 'create_time': 100.0, 'unit': None},
+                'profile2': {'pid': 20, 'create_time': 200.0, 'unit': None}}}
+
+    def test_dump_same_profile(self):
+        self._index.processes[30] = entry(30, 'profile', 300.0)
+        self._index.processes[10] = entry(10, 'profile', 100.0)
+        self._index.processes[20] = entry(20, 'profile', 200.0)
+
+        assert self._index.dump()['processes'] == {
+            'profile': {'pid': 10, 'create_time': 100.0, 'unit': None}}
+
+    def test_answer(self):
+        self._index.read_events = mock.Mock()
+        self._index.processes[10] = entry(10, 'profile')
+        client, server = socket.socketpair()
+        try:
+            client.sendall(b'INDEX\n')
+            index_helper.answer(self._index, server)
+            answer = json.loads(client.makefile().readline())
+        finally:
+            client.close()
+
+        self._index.read_events.assert_called_once_with()
+        assert answer == {
+            'live': False,
+            'processes': {'profile': {'pid': 10, 'create_time': 100.0, 'unit': None}}}
+
+    def test_answer_unknown_request(self):
+        self._index.read_events = mock.Mock()
+        client, server = socket.socketpair()
+        try:
+            client.sendall(b'DUMP\n')
+            index_helper.answer(self._index, server)
+            answer = json.loads(client.makefile().readline())
+        finally:
+            client.close()
+
+        assert answer == {'error': 'unknown request'}
+        assert self._index.read_events.call_count == 0